@@ -41,6 +41,7 @@ class FA12_config:
         self,
         support_upgradable_metadata         = False,
         use_token_metadata_offchain_view    = True,
+        separate_approvals                  = False,
     ):
         self.support_upgradable_metadata = support_upgradable_metadata
         # Whether the contract metadata can be upgradable or not.
@@ -49,6 +50,11 @@ class FA12_config:
         self.use_token_metadata_offchain_view = use_token_metadata_offchain_view
         # Include offchain view for accessing the token metadata (requires TZIP-016 contract metadata)
 
+        self.separate_approvals = separate_approvals
+        # Store the approvals in their own big-map keyed by (owner, spender), `balances`
+        # then only holds the balance. Otherwise every access to a balance (de)serializes
+        # all the approvals of its holder.
+
 class FA12_common:
     def normalize_metadata(self, metadata):
         """
@@ -63,8 +69,18 @@ class FA12_core(sp.Contract, FA12_common):
     def __init__(self, config, **extra_storage):
         self.config = config
 
+        if config.separate_approvals:
+            ledger = dict(
+                balances = sp.big_map(tvalue = sp.TNat),
+                approvals = sp.big_map(tkey = sp.TPair(sp.TAddress, sp.TAddress), tvalue = sp.TNat)
+            )
+        else:
+            ledger = dict(
+                balances = sp.big_map(tvalue = sp.TRecord(approvals = sp.TMap(sp.TAddress, sp.TNat), balance = sp.TNat))
+            )
+
         self.init(
-            balances = sp.big_map(tvalue = sp.TRecord(approvals = sp.TMap(sp.TAddress, sp.TNat), balance = sp.TNat)),
+            **ledger,
             totalSupply = 0,
             **extra_storage
         )
@@ -75,41 +91,114 @@ class FA12_core(sp.Contract, FA12_common):
         sp.verify(self.is_administrator(sp.sender) |
             (~self.is_paused() &
                 ((params.from_ == sp.sender) |
-                 (self.data.balances[params.from_].approvals[sp.sender] >= params.value))), FA12_Error.NotAllowed)
+                 (self.spender_allowance(params.from_, sp.sender) >= params.value))), FA12_Error.NotAllowed)
         self.addAddressIfNecessary(params.from_)
         self.addAddressIfNecessary(params.to_)
-        sp.verify(self.data.balances[params.from_].balance >= params.value, FA12_Error.InsufficientBalance)
-        self.data.balances[params.from_].balance = sp.as_nat(self.data.balances[params.from_].balance - params.value)
-        self.data.balances[params.to_].balance += params.value
+        sp.verify(self.balance_of(params.from_) >= params.value, FA12_Error.InsufficientBalance)
+        self.set_balance(params.from_, sp.as_nat(self.balance_of(params.from_) - params.value))
+        self.set_balance(params.to_, self.balance_of(params.to_) + params.value)
         sp.if (params.from_ != sp.sender) & (~self.is_administrator(sp.sender)):
-            self.data.balances[params.from_].approvals[sp.sender] = sp.as_nat(self.data.balances[params.from_].approvals[sp.sender] - params.value)
+            self.set_allowance(params.from_, sp.sender, sp.as_nat(self.spender_allowance(params.from_, sp.sender) - params.value))
+
+    @sp.entry_point
+    def transfer_batch(self, params):
+        """
+            Not part of TZIP-007: several transfers applied as a whole.
+
+            The allowance and the balance of each owner are checked once against the
+            total of its transfers, as they were before the batch: tokens received in
+            the batch cannot fund transfers of the same batch. Each balance is then
+            written once with the net amount it receives or sends.
+        """
+        sp.set_type(params, sp.TList(sp.TRecord(from_ = sp.TAddress, to_ = sp.TAddress, value = sp.TNat).layout(("from_ as from", ("to_ as to", "value")))))
+        debits = sp.local("debits", sp.map(tkey = sp.TAddress, tvalue = sp.TNat))
+        credits = sp.local("credits", sp.map(tkey = sp.TAddress, tvalue = sp.TNat))
+        sp.for transfer in params:
+            debits.value[transfer.from_] = debits.value.get(transfer.from_, 0) + transfer.value
+            credits.value[transfer.to_] = credits.value.get(transfer.to_, 0) + transfer.value
+        sp.for debit in debits.value.items():
+            sp.verify(self.is_administrator(sp.sender) |
+                (~self.is_paused() &
+                    ((debit.key == sp.sender) |
+                     (self.spender_allowance(debit.key, sp.sender) >= debit.value))), FA12_Error.NotAllowed)
+            self.addAddressIfNecessary(debit.key)
+            sp.if (debit.key != sp.sender) & (~self.is_administrator(sp.sender)):
+                self.set_allowance(debit.key, sp.sender, sp.as_nat(self.spender_allowance(debit.key, sp.sender) - debit.value))
+            balance = sp.local("balance", self.balance_of(debit.key))
+            sp.verify(balance.value >= debit.value, FA12_Error.InsufficientBalance)
+            self.set_balance(debit.key, sp.as_nat(balance.value - debit.value) + credits.value.get(debit.key, 0))
+            del credits.value[debit.key]
+        sp.for credit in credits.value.items():
+            self.addAddressIfNecessary(credit.key)
+            self.set_balance(credit.key, self.balance_of(credit.key) + credit.value)
 
     @sp.entry_point
     def approve(self, params):
         sp.set_type(params, sp.TRecord(spender = sp.TAddress, value = sp.TNat).layout(("spender", "value")))
         self.addAddressIfNecessary(sp.sender)
         sp.verify(~self.is_paused(), FA12_Error.Paused)
-        alreadyApproved = self.data.balances[sp.sender].approvals.get(params.spender, 0)
+        alreadyApproved = self.allowance_of(sp.sender, params.spender)
         sp.verify((alreadyApproved == 0) | (params.value == 0), FA12_Error.UnsafeAllowanceChange)
-        self.data.balances[sp.sender].approvals[params.spender] = params.value
+        self.set_allowance(sp.sender, params.spender, params.value)
 
     def addAddressIfNecessary(self, address):
-        sp.if ~ self.data.balances.contains(address):
-            self.data.balances[address] = sp.record(balance = 0, approvals = {})
+        # with separate approvals, missing balances are read as 0
+        if not self.config.separate_approvals:
+            sp.if ~ self.data.balances.contains(address):
+                self.data.balances[address] = sp.record(balance = 0, approvals = {})
+
+    # accessors of the balances and approvals, for both storage layouts
+    def balance_of(self, address):
+        if self.config.separate_approvals:
+            return self.data.balances.get(address, 0)
+        return self.data.balances[address].balance
+
+    def set_balance(self, address, value):
+        if self.config.separate_approvals:
+            self.data.balances[address] = value
+        else:
+            self.data.balances[address].balance = value
+
+    def allowance_of(self, owner, spender):
+        if self.config.separate_approvals:
+            return self.data.approvals.get(sp.pair(owner, spender), 0)
+        return self.data.balances[owner].approvals.get(spender, 0)
+
+    def spender_allowance(self, owner, spender):
+        # fails for a spender the owner never approved, as in the original template
+        if self.config.separate_approvals:
+            return self.data.approvals[sp.pair(owner, spender)]
+        return self.data.balances[owner].approvals[spender]
+
+    def set_allowance(self, owner, spender, value):
+        # with separate approvals, spent or revoked allowances are removed rather than kept as 0
+        if self.config.separate_approvals:
+            sp.if value == 0:
+                del self.data.approvals[sp.pair(owner, spender)]
+            sp.else:
+                self.data.approvals[sp.pair(owner, spender)] = value
+        else:
+            self.data.balances[owner].approvals[spender] = value
 
     @sp.utils.view(sp.TNat)
     def getBalance(self, params):
-        sp.if self.data.balances.contains(params):
-            sp.result(self.data.balances[params].balance)
-        sp.else:
-            sp.result(sp.nat(0))
+        if self.config.separate_approvals:
+            sp.result(self.balance_of(params))
+        else:
+            sp.if self.data.balances.contains(params):
+                sp.result(self.data.balances[params].balance)
+            sp.else:
+                sp.result(sp.nat(0))
 
     @sp.utils.view(sp.TNat)
     def getAllowance(self, params):
-        sp.if self.data.balances.contains(params.owner):
-            sp.result(self.data.balances[params.owner].approvals.get(params.spender, 0))
-        sp.else:
-            sp.result(sp.nat(0))
+        if self.config.separate_approvals:
+            sp.result(self.allowance_of(params.owner, params.spender))
+        else:
+            sp.if self.data.balances.contains(params.owner):
+                sp.result(self.data.balances[params.owner].approvals.get(params.spender, 0))
+            sp.else:
+                sp.result(sp.nat(0))
 
     @sp.utils.view(sp.TNat)
     def getTotalSupply(self, params):
@@ -129,15 +218,15 @@ class FA12_mint_burn(FA12_core):
     def mint(self, params):
         sp.set_type(params, sp.TRecord(address = sp.TAddress, value = sp.TNat))
         self.addAddressIfNecessary(params.address)
-        self.data.balances[params.address].balance += params.value
+        self.set_balance(params.address, self.balance_of(params.address) + params.value)
         self.data.totalSupply += params.value
 
     @sp.entry_point
     def burn(self, params):
         sp.set_type(params, sp.TRecord(address = sp.TAddress, value = sp.TNat))
         sp.verify(self.is_administrator(sp.sender), FA12_Error.NotAdmin)
-        sp.verify(self.data.balances[params.address].balance >= params.value, FA12_Error.InsufficientBalance)
-        self.data.balances[params.address].balance = sp.as_nat(self.data.balances[params.address].balance - params.value)
+        sp.verify(self.balance_of(params.address) >= params.value, FA12_Error.InsufficientBalance)
+        self.set_balance(params.address, sp.as_nat(self.balance_of(params.address) - params.value))
         self.data.totalSupply = sp.as_nat(self.data.totalSupply - params.value)
 
 class FA12_administrator(FA12_core):
@@ -427,6 +516,156 @@ if "templates" not in __name__ and __name__ != "__main__":
         c1.getAllowance((sp.record(owner = alice.address, spender = bob.address), view_allowance.typed.target))
         scenario.verify_equal(view_allowance.data.last, sp.some(1))
 
+        scenario.h1("Batch transfers")
+        scenario.h2("Alice transfers to Bob and Administrator at once")
+        c1.transfer_batch([
+            sp.record(from_ = alice.address, to_ = bob.address, value = 2),
+            sp.record(from_ = alice.address, to_ = admin.address, value = 1)
+        ]).run(sender = alice)
+        scenario.verify(c1.data.balances[alice.address].balance == 5)
+        scenario.verify(c1.data.balances[bob.address].balance == 11)
+        scenario.verify(c1.data.balances[admin.address].balance == 1)
+        scenario.h2("Bob's transfers from Alice are checked against her allowance as a whole")
+        c1.transfer_batch([
+            sp.record(from_ = alice.address, to_ = bob.address, value = 1),
+            sp.record(from_ = alice.address, to_ = admin.address, value = 1)
+        ]).run(sender = bob, valid = False)
+        scenario.h2("Bob transfers from Alice and from himself")
+        c1.transfer_batch([
+            sp.record(from_ = alice.address, to_ = bob.address, value = 1),
+            sp.record(from_ = bob.address, to_ = alice.address, value = 3)
+        ]).run(sender = bob)
+        scenario.verify(c1.data.balances[alice.address].approvals[bob.address] == 0)
+        scenario.h2("Without an allowance left, Bob cannot transfer from Alice")
+        c1.transfer_batch([
+            sp.record(from_ = alice.address, to_ = bob.address, value = 1)
+        ]).run(sender = bob, valid = False)
+        scenario.verify(c1.data.balances[alice.address].balance == 7)
+        scenario.verify(c1.data.balances[bob.address].balance == 9)
+        scenario.h2("Tokens received in a batch cannot be sent in the same batch")
+        c1.transfer_batch([
+            sp.record(from_ = alice.address, to_ = alice.address, value = 8)
+        ]).run(sender = alice, valid = False)
+        c1.transfer_batch([
+            sp.record(from_ = alice.address, to_ = admin.address, value = 2),
+            sp.record(from_ = admin.address, to_ = bob.address, value = 3)
+        ]).run(sender = admin, valid = False)
+        scenario.verify(c1.data.balances[alice.address].balance == 7)
+        scenario.verify(c1.data.balances[admin.address].balance == 1)
+        scenario.h2("Alice cannot send more than she has")
+        c1.transfer_batch([
+            sp.record(from_ = alice.address, to_ = bob.address, value = 7),
+            sp.record(from_ = alice.address, to_ = admin.address, value = 1)
+        ]).run(sender = alice, valid = False)
+        scenario.verify(c1.data.totalSupply == 17)
+
+    @sp.add_test(name = "FA12-separate_approvals")
+    def test():
+
+        scenario = sp.test_scenario()
+        scenario.h1("FA1.2 template - Approvals in their own big-map")
+
+        admin = sp.test_account("Administrator")
+        alice = sp.test_account("Alice")
+        bob   = sp.test_account("Robert")
+
+        c1 = FA12(
+            admin.address,
+            config              = FA12_config(separate_approvals = True),
+            contract_metadata   = {
+                "" : "ipfs://QmaiAUj1FFNGYTu8rLBjc3eeN9cSKwaF8EGMBNDmhzPNFd",
+            }
+        )
+        scenario += c1
+
+        scenario.h2("Admin mints and Alice transfers to Bob")
+        c1.mint(address = alice.address, value = 18).run(sender = admin)
+        c1.transfer(from_ = alice.address, to_ = bob.address, value = 4).run(sender = alice)
+        scenario.verify(c1.data.balances[alice.address] == 14)
+        scenario.verify(c1.data.balances[bob.address] == 4)
+        scenario.h2("Alice approves Bob and Bob transfers")
+        c1.transfer(from_ = alice.address, to_ = bob.address, value = 4).run(sender = bob, valid = False)
+        c1.approve(spender = bob.address, value = 5).run(sender = alice)
+        c1.approve(spender = bob.address, value = 6).run(sender = alice, valid = False)
+        c1.transfer(from_ = alice.address, to_ = bob.address, value = 4).run(sender = bob)
+        scenario.verify(c1.data.approvals[(alice.address, bob.address)] == 1)
+        c1.transfer(from_ = alice.address, to_ = bob.address, value = 4).run(sender = bob, valid = False)
+        scenario.h2("Batch transfers spend the allowance once")
+        c1.transfer_batch([
+            sp.record(from_ = alice.address, to_ = bob.address, value = 1),
+            sp.record(from_ = bob.address, to_ = admin.address, value = 2)
+        ]).run(sender = bob)
+        scenario.verify(~c1.data.approvals.contains((alice.address, bob.address)))
+        c1.transfer(from_ = alice.address, to_ = bob.address, value = 0).run(sender = bob, valid = False)
+        scenario.h2("Approving 0 removes the allowance")
+        c1.approve(spender = admin.address, value = 3).run(sender = bob)
+        scenario.verify(c1.data.approvals[(bob.address, admin.address)] == 3)
+        c1.approve(spender = admin.address, value = 0).run(sender = bob)
+        scenario.verify(~c1.data.approvals.contains((bob.address, admin.address)))
+        scenario.verify(c1.data.balances[alice.address] == 9)
+        scenario.verify(c1.data.balances[bob.address] == 7)
+        scenario.verify(c1.data.balances[admin.address] == 2)
+        scenario.h2("Admin burns Bob tokens")
+        c1.burn(address = bob.address, value = 8).run(sender = admin, valid = False)
+        c1.burn(address = bob.address, value = 7).run(sender = admin)
+        scenario.verify(c1.data.totalSupply == 11)
+
+        scenario.h2("Views")
+        view_balance = Viewer(sp.TNat)
+        scenario += view_balance
+        c1.getBalance((alice.address, view_balance.typed.target))
+        scenario.verify_equal(view_balance.data.last, sp.some(9))
+        c1.getBalance((sp.address("tz1M9CMEtsXm3QxA7FmMU2Qh7xzsuGXVbcDr"), view_balance.typed.target))
+        scenario.verify_equal(view_balance.data.last, sp.some(0))
+        view_allowance = Viewer(sp.TNat)
+        scenario += view_allowance
+        c1.getAllowance((sp.record(owner = alice.address, spender = admin.address), view_allowance.typed.target))
+        scenario.verify_equal(view_allowance.data.last, sp.some(0))
+
+    # Transfers of a holder with many approvals, with both storage layouts. The scenarios
+    # only run the operations, their gas has to be measured on a node.
+    def add_approvals_bench(separate_approvals, approvals):
+        name = "FA12-approvals_%d" % approvals
+        if separate_approvals:
+            name += "-separate_approvals"
+
+        @sp.add_test(name = name, is_default = False)
+        def test():
+            scenario = sp.test_scenario()
+            scenario.h1("FA1.2 transfers of a holder with %d approvals" % approvals)
+
+            admin = sp.test_account("Administrator")
+            alice = sp.test_account("Alice")
+            bob   = sp.test_account("Robert")
+
+            c1 = FA12(
+                admin.address,
+                config              = FA12_config(separate_approvals = separate_approvals),
+                contract_metadata   = {
+                    "" : "ipfs://QmaiAUj1FFNGYTu8rLBjc3eeN9cSKwaF8EGMBNDmhzPNFd",
+                }
+            )
+            scenario += c1
+
+            c1.mint(address = alice.address, value = 1000).run(sender = admin)
+
+            scenario.h2("Alice approves %d spenders" % approvals)
+            c1.approve(spender = bob.address, value = 100).run(sender = alice)
+            for i in range(approvals - 1):
+                c1.approve(spender = sp.test_account("Spender%d" % i).address, value = 1).run(sender = alice)
+
+            scenario.h2("Alice transfers")
+            c1.transfer(from_ = alice.address, to_ = admin.address, value = 1).run(sender = alice)
+            scenario.h2("Bob transfers from Alice")
+            c1.transfer(from_ = alice.address, to_ = bob.address, value = 1).run(sender = bob)
+            scenario.h2("Admin mints to Alice")
+            c1.mint(address = alice.address, value = 1).run(sender = admin)
+            scenario.verify(c1.data.totalSupply == 1001)
+
+    for separate_approvals in [False, True]:
+        for approvals in [1, 100, 1000]:
+            add_approvals_bench(separate_approvals, approvals)
+
     # sp.add_compilation_target(
     #     "FA1_2",
     #     FA12(
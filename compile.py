@@ -1,6 +1,8 @@
 import smartpy as sp
 
-Radiate = sp.io.import_script_from_url("file:smart_contracts/contract.py").Radiate
+Radiate_module = sp.io.import_script_from_url("file:smart_contracts/contract.py")
+Radiate = Radiate_module.Radiate
+Radiate_config = Radiate_module.Radiate_config
 
 FA12_module = sp.io.import_script_from_url("file:FA12.py")
 FA12 = FA12_module.FA12
@@ -42,8 +44,18 @@ sp.add_compilation_target(
 )
 
 
-sp.add_compilation_target(
-    "Radiate",
-    Radiate(admin = sp.address("tz1f85LjxaHfWfPuNtZFg1aVBiaAkVnVnKsH")),
-    flags = [["default_record_layout", "comb"]]
-)
\ No newline at end of file
+# each configuration is compiled under its name, "Radiate" for the default one
+for config in [
+    Radiate_config(),
+    Radiate_config(support_tez = False, support_FA12 = False),
+    Radiate_config(use_sub_entry_points = False),
+    Radiate_config(lazy_entry_points = True)
+]:
+    sp.add_compilation_target(
+        config.name,
+        Radiate(
+            admin = sp.address("tz1f85LjxaHfWfPuNtZFg1aVBiaAkVnVnKsH"),
+            config = config
+        ),
+        flags = [["default_record_layout", "comb"]]
+    )
@@ -1,2 +1,8 @@
 SMARTPY=~/smartpy-cli/SmartPy.sh
 $SMARTPY compile compile.py .compiled/ --html --purge
+
+# size of the compiled Michelson of every target, to compare code size across changes
+echo "Contract sizes (bytes):"
+for target in .compiled/*/; do
+    echo "  $(cat $target*contract.tz | wc -c) $target"
+done
@@ -9,32 +9,338 @@ TokenType = sp.TVariant(
     )
 )
 
+StreamParams = sp.TRecord(
+    ratePerSecond = sp.TNat,
+    startTime = sp.TTimestamp,
+    stopTime = sp.TTimestamp,
+    receiver = sp.TAddress,
+    token = TokenType
+)
+
+# a piecewise schedule streams each segment's ratePerSecond until its segmentEnd,
+# each segment starting where the previous one ended
+Segment = sp.TRecord(
+    segmentEnd = sp.TTimestamp,
+    ratePerSecond = sp.TNat
+)
+
+MAX_SEGMENTS = 10
+
+# a stream migrated from a previous deployment, with what is left of its deposit
+ImportedStream = sp.TRecord(
+    ratePerSecond = sp.TNat,
+    startTime = sp.TTimestamp,
+    stopTime = sp.TTimestamp,
+    receiver = sp.TAddress,
+    sender = sp.TAddress,
+    token = TokenType,
+    remainingBalance = sp.TNat,
+    segments = sp.TList(Segment)
+)
+
+# a withdrawal signed by the receiver of the stream, relayed by anyone
+Permit = sp.TRecord(
+    publicKey = sp.TKey,
+    signature = sp.TSignature,
+    streamId = sp.TNat,
+    amount = sp.TNat
+)
+
+def permitPayload(chainId, contract, counter, streamId, amount):
+    # what the receiver signs, packed
+    return sp.record(
+        chainId = chainId,
+        contract = contract,
+        counter = counter,
+        streamId = streamId,
+        amount = amount
+    )
+
+# fixed point scale of the reward accumulator
+REWARD_PRECISION = 1000000000000
+
+# receivers of a split stream are paid pro rata to their share of the stream
+SplitReceiver = sp.TRecord(
+    share = sp.TNat,
+    withdrawn = sp.TNat
+)
+
+MAX_SPLIT_RECEIVERS = 50
+
+TZIP16_Metadata_Base = {
+    "name"          : "Radiate",
+    "description"   : "Token streaming for tez, FA1.2 and FA2 tokens",
+    "interfaces"    : [
+        "TZIP-016-2021-04-17"
+    ],
+}
+
+# payloads of the events emitted along the lifecycle of a stream
+# imported streams are created with part of their deposit already withdrawn
+StreamCreatedEvent = sp.TRecord(
+    streamId = sp.TNat,
+    sender = sp.TAddress,
+    receiver = sp.TAddress,
+    token = TokenType,
+    deposit = sp.TNat,
+    remainingBalance = sp.TNat
+)
+
+WithdrawalEvent = sp.TRecord(
+    streamId = sp.TNat,
+    receiver = sp.TAddress,
+    token = TokenType,
+    amount = sp.TNat,
+    remainingBalance = sp.TNat
+)
+
+StreamCancelledEvent = sp.TRecord(
+    streamId = sp.TNat,
+    sender = sp.TAddress,
+    receiver = sp.TAddress,
+    token = TokenType,
+    senderBalance = sp.TNat,
+    receiverBalance = sp.TNat
+)
+
+StreamSettledEvent = sp.TRecord(
+    streamId = sp.TNat,
+    sender = sp.TAddress,
+    receiver = sp.TAddress,
+    token = TokenType,
+    receiverBalance = sp.TNat
+)
+
+StreamExtendedEvent = sp.TRecord(
+    streamId = sp.TNat,
+    stopTime = sp.TTimestamp,
+    extraDeposit = sp.TNat
+)
+
+SplitStreamCreatedEvent = sp.TRecord(
+    streamId = sp.TNat,
+    sender = sp.TAddress,
+    receivers = sp.TMap(sp.TAddress, sp.TNat),
+    token = TokenType,
+    deposit = sp.TNat
+)
+
+SplitWithdrawalEvent = sp.TRecord(
+    streamId = sp.TNat,
+    receiver = sp.TAddress,
+    token = TokenType,
+    amount = sp.TNat,
+    remainingBalance = sp.TNat
+)
+
+SplitStreamCancelledEvent = sp.TRecord(
+    streamId = sp.TNat,
+    sender = sp.TAddress,
+    token = TokenType,
+    senderBalance = sp.TNat,
+    receiverBalances = sp.TMap(sp.TAddress, sp.TNat)
+)
+
+RewardsCollectedEvent = sp.TRecord(
+    address = sp.TAddress,
+    amount = sp.TNat,
+    remainingRewards = sp.TNat
+)
+
+FA12TransferType = sp.TRecord(
+    from_ = sp.TAddress,
+    to_ = sp.TAddress,
+    value = sp.TNat
+).layout(("from_ as from", ("to_ as to", "value")))
+
+FA2TransferTxType = sp.TRecord(
+    amount = sp.TNat,
+    to_ = sp.TAddress,
+    token_id = sp.TNat
+).layout(("to_", ("token_id", "amount")))
+
+FA2TransferType = sp.TList(
+    sp.TRecord(
+        from_ = sp.TAddress,
+        txs = sp.TList(FA2TransferTxType)
+    ).layout(("from_", "txs"))
+)
+
+class Radiate_config:
+    def __init__(
+        self,
+        support_tez             = True,
+        support_FA12            = True,
+        support_FA2             = True,
+        support_rewards         = True,
+        use_sub_entry_points    = True,
+        lazy_entry_points       = False,
+        emit_events             = True,
+    ):
+        self.support_tez = support_tez
+        self.support_FA12 = support_FA12
+        self.support_FA2 = support_FA2
+        # Token kinds that can be streamed, the branches of the others are compiled
+        # to a failure and such tokens are rejected when first registered.
+
+        self.support_rewards = support_rewards and support_tez
+        # Baker rewards shared by the parties of tez streams. When False the
+        # `default`, `delegate` and `collect_management_rewards` entry points and
+        # the reward storage are left out.
+
+        self.use_sub_entry_points = use_sub_entry_points
+        # Share the time, balance, deposit and transfer computations as sub entry
+        # points (lambdas) instead of inlining them at every call site.
+
+        self.lazy_entry_points = lazy_entry_points
+        # Store every entry point but the hot create and withdraw ones in a big_map,
+        # so that the cold ones (admin, cancel, settle...) are only loaded when called.
+
+        self.emit_events = emit_events
+        # Emit typed events when streams and split streams are created, withdrawn
+        # from, extended, settled or cancelled and when the admin collects rewards,
+        # for indexers to follow.
+
+        name = "Radiate"
+        if not support_tez:
+            name += "-no_tez"
+        if not support_FA12:
+            name += "-no_FA12"
+        if not support_FA2:
+            name += "-no_FA2"
+        if not self.support_rewards:
+            name += "-no_rewards"
+        if not use_sub_entry_points:
+            name += "-inline"
+        if lazy_entry_points:
+            name += "-lep"
+        if not emit_events:
+            name += "-no_events"
+        self.name = name
+
+def streamedAmountOf(stream, segments, timeDifference, suffix = ""):
+    # amount streamed during the first `timeDifference` seconds of the stream,
+    # constant rate streams have no segments and piecewise ones have a zero ratePerSecond,
+    # the suffix keeps the locals of several inlined copies apart
+    amount = sp.local("amount" + suffix, timeDifference * stream.ratePerSecond)
+
+    segmentStart = sp.local("segmentStart" + suffix, stream.startTime)
+    until = sp.local("until" + suffix, sp.add_seconds(stream.startTime, sp.to_int(timeDifference)))
+
+    sp.for segment in segments:
+        sp.if segmentStart.value < until.value:
+            amount.value += sp.as_nat(sp.min(segment.segmentEnd, until.value) - segmentStart.value) * segment.ratePerSecond
+        segmentStart.value = segment.segmentEnd
+
+    return amount.value
+
+# the reward entry points are optional, hence they are defined outside the class
+def default(contract):
+    amount = sp.utils.mutez_to_nat(sp.amount)
+
+    # the sender and the receiver of a tez stream each earn a quarter of the rewards,
+    # pro rata to the stream's share of the tez deposits, the admin keeps the rest
+    sp.if contract.data.tezDeposits > 0:
+        partiesShare = sp.local("partiesShare", amount / 2).value
+        contract.data.streamRewards += partiesShare
+        contract.data.rewardPerDeposit += partiesShare * REWARD_PRECISION / (contract.data.tezDeposits * 2)
+        contract.data.rewards += sp.as_nat(amount - partiesShare)
+    sp.else:
+        contract.data.rewards += amount
+
+def delegate(contract, baker):
+    sp.verify(sp.sender == contract.data.admin)
+    sp.verify(sp.amount == sp.mutez(0))
+    sp.set_delegate(baker)
+
+def collect_management_rewards(contract, params):
+    # only the admin's share, the parties' share stays in streamRewards
+    sp.verify(sp.sender == contract.data.admin)
+    sp.verify(params.amount <= contract.data.rewards)
+    sp.send(params.address, sp.utils.nat_to_mutez(params.amount))
+    contract.data.rewards = sp.as_nat(contract.data.rewards - params.amount)
+    contract.emitEvent("rewardsCollected", RewardsCollectedEvent, sp.record(
+        address = params.address,
+        amount = params.amount,
+        remainingRewards = contract.data.rewards
+    ))
+
 class Radiate(sp.Contract):
-    def __init__(self, admin):
+    def __init__(self, admin, config = Radiate_config()):
+        self.config = config
+        # counts the inlined copies of streamedAmountOf, to name their locals
+        self.inlinedAmounts = 0
+
+        streamType = dict(
+            ratePerSecond = sp.TNat,
+            startTime = sp.TTimestamp,
+            stopTime = sp.TTimestamp,
+            receiver = sp.TAddress,
+            sender = sp.TAddress,
+            tokenIndex = sp.TNat,
+            withdrawn = sp.TNat
+        )
+        rewardStorage = {}
+
+        if config.support_rewards:
+            streamType["rewardSnapshot"] = sp.TNat
+            rewardStorage = dict(
+                rewards = sp.nat(0),
+                # the parties' share of the rewards, paid out as their streams deplete
+                streamRewards = sp.nat(0),
+                rewardPerDeposit = sp.nat(0),
+                tezDeposits = sp.nat(0)
+            )
+            self.ep = sp.entry_point(default, name = "default")
+            self.delegate = sp.entry_point(delegate)
+            self.collect_management_rewards = sp.entry_point(collect_management_rewards)
+
+        if config.lazy_entry_points:
+            self.add_flag("lazy-entry-points")
+
         self.init(
             nextStreamId = sp.nat(0),
             admin = admin,
-            rewards = sp.nat(0),
+            importing = True,
+            **rewardStorage,
             streams = sp.big_map(
                 tkey = sp.TNat, 
+                tvalue = sp.TRecord(**streamType)
+            ),
+            # piecewise schedules, only segmented streams have one
+            schedules = sp.big_map(tkey = sp.TNat, tvalue = sp.TList(Segment)),
+            splitStreams = sp.big_map(
+                tkey = sp.TNat,
                 tvalue = sp.TRecord(
-                    deposit = sp.TNat,
                     ratePerSecond = sp.TNat,
-                    remainingBalance = sp.TNat,
                     startTime = sp.TTimestamp,
                     stopTime = sp.TTimestamp,
-                    receiver = sp.TAddress,
                     sender = sp.TAddress,
-                    token = TokenType
+                    tokenIndex = sp.TNat,
+                    receivers = sp.TMap(sp.TAddress, SplitReceiver),
+                    totalShares = sp.TNat,
+                    withdrawn = sp.TNat
                 )
             ),
+            tokens = sp.big_map(tkey = sp.TNat, tvalue = TokenType),
+            tokenIndexes = sp.big_map(tkey = TokenType, tvalue = sp.TNat),
+            nextTokenIndex = sp.nat(0),
+            streamsBySender = sp.big_map(tkey = sp.TAddress, tvalue = sp.TSet(sp.TNat)),
+            streamsByReceiver = sp.big_map(tkey = sp.TAddress, tvalue = sp.TSet(sp.TNat)),
+            permitCounters = sp.big_map(tkey = sp.TAddress, tvalue = sp.TNat),
             metadata = sp.utils.metadata_of_url("ipfs://QmZcjtDZVGenfkHG321UfhPKEn7saKVQJJabiDEnKmNEB7")
         )
 
-    @sp.entry_point(name = "default")
-    def ep(self):
-        self.data.rewards += sp.utils.mutez_to_nat(sp.amount)
-        pass
+        # TZIP-016 metadata published at the metadata url, with the off-chain views
+        self.init_metadata("metadata", {
+            **TZIP16_Metadata_Base,
+            "version"       : config.name,
+            "views"         : [self.getStreams, self.getStreamsFor]
+        })
+
+    def emitEvent(self, tag, t, event):
+        if self.config.emit_events:
+            sp.emit(sp.set_type_expr(event, t), tag = tag, with_type = True)
 
     def checkStartTime(self, startTime):
         sp.verify(startTime > sp.now, message = "START_TIME_LESS_THAN_CURRENT_TIME")
@@ -42,150 +348,658 @@ class Radiate(sp.Contract):
     def checkStopTime(self, startTime, stopTime):
         sp.verify(stopTime > startTime, message = "STOP_TIME_LESS_THAN_START_TIME")
 
+    def checkRate(self, ratePerSecond):
+        # a zero ratePerSecond marks a segmented stream
+        sp.verify(ratePerSecond > 0, message = "INVALID_RATE")
+
     @sp.sub_entry_point
     def getDeposit(self, params):
         sp.verify(params.stopTime >= params.startTime)
         duration = sp.as_nat(params.stopTime - params.startTime)
         sp.result(duration * params.ratePerSecond)
 
+    def depositFor(self, startTime, stopTime, ratePerSecond):
+        params = sp.record(startTime = startTime, stopTime = stopTime, ratePerSecond = ratePerSecond)
+        if self.config.use_sub_entry_points:
+            return self.getDeposit(params)
+        sp.verify(stopTime >= startTime)
+        return sp.as_nat(stopTime - startTime) * ratePerSecond
+
     def checkValidReceiver(self, receiver, sender):
         sp.verify(receiver != sender, message = "INVALID_RECEIVER")
 
-    @sp.entry_point
-    def delegate(self, baker):
-        sp.verify(sp.sender == self.data.admin)
-        sp.verify(sp.amount == sp.mutez(0))
-        sp.set_delegate(baker)
+    def streamedTime(self, stream, now):
+        # seconds streamed at `now`, between 0 and the stream duration
+        return sp.as_nat(sp.min(sp.max(now, stream.startTime), stream.stopTime) - stream.startTime)
+
+    def segmentsOf(self, streamId, stream):
+        # piecewise streams have a zero ratePerSecond, constant rate ones skip the schedules lookup
+        segments = sp.local("segments", sp.list([], t = Segment))
+        sp.if stream.ratePerSecond == 0:
+            segments.value = self.data.schedules.get(streamId, sp.list([], t = Segment))
+        return segments.value
+
+    @sp.global_lambda
+    def amountStreamed(params):
+        sp.result(streamedAmountOf(params.stream, params.segments, params.timeDifference))
+
+    def streamedAmount(self, stream, segments, timeDifference):
+        if self.config.use_sub_entry_points:
+            return self.amountStreamed(sp.record(stream = stream, segments = segments, timeDifference = timeDifference))
+        self.inlinedAmounts += 1
+        return streamedAmountOf(stream, segments, timeDifference, "_%d" % self.inlinedAmounts)
+
+    def depositOf(self, stream, segments):
+        # the record only keeps what cannot be derived, the deposit follows from the schedule
+        return self.streamedAmount(stream, segments, sp.as_nat(stream.stopTime - stream.startTime))
+
+    def remainingBalanceOf(self, stream, segments):
+        return sp.as_nat(self.depositOf(stream, segments) - stream.withdrawn)
+
+    def receiverBalanceOf(self, stream, segments, timeDifference):
+        # streamed so far minus what the receiver already withdrew
+        return sp.as_nat(self.streamedAmount(stream, segments, timeDifference) - stream.withdrawn)
+
+    def splitDepositOf(self, stream):
+        return sp.as_nat(stream.stopTime - stream.startTime) * stream.ratePerSecond
+
+    def splitReceiverBalanceOf(self, stream, receiver, timeDifference):
+        # the receiver's share of what was streamed so far minus what it already withdrew
+        return sp.as_nat(timeDifference * stream.ratePerSecond * receiver.share / stream.totalShares - receiver.withdrawn)
 
-    @sp.entry_point
-    def collect_management_rewards(self, params):
-        sp.verify(sp.sender == self.data.admin)
-        sp.verify(params.amount <= self.data.rewards)
-        sp.send(params.address, sp.utils.nat_to_mutez(params.amount))
-        self.data.rewards = sp.as_nat(self.data.rewards - params.amount)
-    
     @sp.sub_entry_point
-    def timeDifference(self, streamId):
-        stream = self.data.streams[streamId]
+    def timeDifference(self, stream):
+        sp.result(self.streamedTime(stream, sp.now))
+
+    def elapsedTime(self, stream):
+        if self.config.use_sub_entry_points:
+            return self.timeDifference(stream)
+        return self.streamedTime(stream, sp.now)
+
+    @sp.sub_entry_point
+    def balanceOfReceiver(self, params):  
+        sp.result(self.receiverBalanceOf(params.stream, params.segments, params.timeDifference))
+
+    def receiverBalance(self, stream, segments, timeDifference):
+        if self.config.use_sub_entry_points:
+            return self.balanceOfReceiver(sp.record(stream = stream, segments = segments, timeDifference = timeDifference))
+        return self.receiverBalanceOf(stream, segments, timeDifference)
+
+    def addToIndex(self, index, address, streamId):
+        sp.if index.contains(address):
+            index[address].add(streamId)
+        sp.else:
+            index[address] = sp.set([streamId])
+
+    def removeFromIndex(self, index, address, streamId):
+        # empty sets are dropped so that the index only holds live streams
+        index[address].remove(streamId)
+        sp.if sp.len(index[address]) == 0:
+            del index[address]
+
+    def indexStream(self, streamId, sender, receiver):
+        self.addToIndex(self.data.streamsBySender, sender, streamId)
+        self.addToIndex(self.data.streamsByReceiver, receiver, streamId)
+
+    def unindexStream(self, streamId, stream):
+        self.removeFromIndex(self.data.streamsBySender, stream.sender, streamId)
+        self.removeFromIndex(self.data.streamsByReceiver, stream.receiver, streamId)
+
+    def deleteStream(self, streamId, stream):
+        self.unindexStream(streamId, stream)
+        del self.data.streams[streamId]
+        sp.if stream.ratePerSecond == 0:
+            del self.data.schedules[streamId]
+
+    def newStream(self, **fields):
+        # tez streams earn rewards from the accumulator value at their creation
+        if self.config.support_rewards:
+            fields["rewardSnapshot"] = self.data.rewardPerDeposit
+        return sp.record(**fields)
+
+    def addTezDeposit(self, token, deposit):
+        if self.config.support_rewards:
+            sp.if token.is_variant("tez"):
+                self.data.tezDeposits += deposit
+
+    def releaseTezDeposit(self, deposit):
+        self.data.tezDeposits = sp.as_nat(self.data.tezDeposits - deposit)
+
+    def cancelTezDeposit(self, token, stream, segments):
+        # cancelled streams forfeit what they accrued to the admin's share
+        if self.config.support_rewards:
+            sp.if token.is_variant("tez"):
+                deposit = sp.local("deposit", self.depositOf(stream, segments)).value
+                forfeited = sp.local("forfeited", self.accruedReward(stream, deposit) * 2).value
+                self.data.streamRewards = sp.as_nat(self.data.streamRewards - forfeited)
+                self.data.rewards += forfeited
+                self.releaseTezDeposit(deposit)
+
+    def accruedReward(self, stream, deposit):
+        # reward of each party since the stream took its snapshot of the accumulator
+        return deposit * sp.as_nat(self.data.rewardPerDeposit - stream.rewardSnapshot) / REWARD_PRECISION
+
+    def payDepletionReward(self, token, stream, segments, payouts = None):
+        # without payouts the rewards are sent right away
+        if self.config.support_rewards:
+            sp.if token.is_variant("tez"):
+                reward = self.depletionReward(stream, segments)
+                if payouts is None:
+                    # no zero tez transfers, as in addPayout
+                    sp.if reward > 0:
+                        sp.send(stream.sender, sp.utils.nat_to_mutez(reward), message = "YIELD_REWARDS")
+                        sp.send(stream.receiver, sp.utils.nat_to_mutez(reward), message = "YIELD_REWARDS")
+                else:
+                    self.addPayout(payouts, token, stream.sender, reward)
+                    self.addPayout(payouts, token, stream.receiver, reward)
+
+    def depletionReward(self, stream, segments):
+        # yield paid to both the sender and the receiver when a tez stream is depleted,
+        # accrued on its deposit since the stream took its snapshot of the accumulator
+        deposit = sp.local("deposit", self.depositOf(stream, segments)).value
+        reward = sp.local("reward", self.accruedReward(stream, deposit))
+
+        self.data.streamRewards = sp.as_nat(self.data.streamRewards - (reward.value * 2))
+        self.releaseTezDeposit(deposit)
+        return reward.value
+
+    @sp.onchain_view()
+    def getStream(self, streamId):
+        sp.set_type(streamId, sp.TNat)
+        sp.result(self.data.streams[streamId])
+
+    @sp.onchain_view()
+    def getSchedule(self, streamId):
+        # segments of a piecewise stream, empty for constant rate streams
+        sp.set_type(streamId, sp.TNat)
+        sp.result(self.data.schedules.get(streamId, sp.list([], t = Segment)))
+
+    @sp.onchain_view()
+    def getSplitStream(self, streamId):
+        sp.set_type(streamId, sp.TNat)
+        sp.result(self.data.splitStreams[streamId])
+
+    @sp.onchain_view()
+    def getToken(self, tokenIndex):
+        sp.set_type(tokenIndex, sp.TNat)
+        sp.result(self.data.tokens[tokenIndex])
 
-        sp.if (sp.now < stream.startTime):
-            sp.result(sp.as_nat(0))
+    @sp.onchain_view()
+    def getPermitCounter(self, address):
+        # counter the next permit of the address has to sign
+        sp.set_type(address, sp.TAddress)
+        sp.result(self.data.permitCounters.get(address, 0))
+
+    @sp.onchain_view()
+    def balanceOf(self, params):
+        # balance of the receiver or the sender of the stream at the current time
+        sp.set_type(params, sp.TRecord(
+            streamId = sp.TNat,
+            who = sp.TAddress
+        ))
+
+        stream = sp.local("stream", self.data.streams[params.streamId]).value
+        segments = self.segmentsOf(params.streamId, stream)
+        receiverBalance = sp.local("receiverBalance", self.receiverBalanceOf(stream, segments, self.streamedTime(stream, sp.now))).value
+
+        sp.if params.who == stream.receiver:
+            sp.result(receiverBalance)
         sp.else:
-            sp.if (stream.stopTime > sp.now):
-                sp.result(sp.as_nat(sp.now - stream.startTime))
+            sp.if params.who == stream.sender:
+                sp.result(sp.as_nat(self.remainingBalanceOf(stream, segments) - receiverBalance))
             sp.else:
-                sp.result(sp.as_nat(stream.stopTime - stream.startTime))
+                sp.result(sp.nat(0))
+
+    def addToPage(self, page, streamId, now):
+        # split streams share the ids, they go to their own list and deleted streams are left out
+        sp.if self.data.streams.contains(streamId):
+            stream = sp.local("stream", self.data.streams[streamId]).value
+            segments = self.segmentsOf(streamId, stream)
+            receiverBalance = sp.local("receiverBalance", self.receiverBalanceOf(stream, segments, self.streamedTime(stream, now))).value
+
+            page.value.streams.push(sp.record(
+                streamId = streamId,
+                stream = stream,
+                segments = segments,
+                receiverBalance = receiverBalance,
+                senderBalance = sp.as_nat(self.remainingBalanceOf(stream, segments) - receiverBalance)
+            ))
+
+        sp.if self.data.splitStreams.contains(streamId):
+            stream = sp.local("stream", self.data.splitStreams[streamId]).value
+            timeDiff = sp.local("timeDiff", self.streamedTime(stream, now)).value
+            paid = sp.local("paid", stream.withdrawn)
+            receiverBalances = sp.local("receiverBalances", sp.map(tkey = sp.TAddress, tvalue = sp.TNat))
+
+            sp.for receiver in stream.receivers.items():
+                receiverBalance = sp.local("receiverBalance", self.splitReceiverBalanceOf(stream, receiver.value, timeDiff)).value
+                paid.value += receiverBalance
+                receiverBalances.value[receiver.key] = receiverBalance
+
+            page.value.splitStreams.push(sp.record(
+                streamId = streamId,
+                stream = stream,
+                receiverBalances = receiverBalances.value,
+                senderBalance = sp.as_nat(self.splitDepositOf(stream) - paid.value)
+            ))
+
+    def newPage(self):
+        return sp.local("page", sp.record(streams = sp.list([]), splitStreams = sp.list([])))
+
+    def pageResult(self, page):
+        return sp.record(streams = page.value.streams.rev(), splitStreams = page.value.splitStreams.rev())
+
+    @sp.offchain_view(pure = False, doc = "Get the streams and split streams with ids from fromId to fromId + count - 1 and their balances now")
+    def getStreams(self, params):
+        sp.set_type(params, sp.TRecord(
+            fromId = sp.TNat,
+            count = sp.TNat
+        ))
+
+        page = self.newPage()
+
+        sp.for streamId in sp.range(params.fromId, params.fromId + params.count):
+            self.addToPage(page, streamId, sp.now)
+
+        sp.result(self.pageResult(page))
+
+    @sp.offchain_view(pure = True, doc = "Get the streams and split streams sent or received by an address and their balances at a given time")
+    def getStreamsFor(self, params):
+        sp.set_type(params, sp.TRecord(
+            address = sp.TAddress,
+            now = sp.TTimestamp
+        ))
+
+        page = self.newPage()
+
+        sp.for streamId in self.data.streamsBySender.get(params.address, sp.set([])).elements():
+            self.addToPage(page, streamId, params.now)
+
+        sp.for streamId in self.data.streamsByReceiver.get(params.address, sp.set([])).elements():
+            self.addToPage(page, streamId, params.now)
 
+        sp.result(self.pageResult(page))
+
+    def registerToken(self, token):
+        # streams keep the index of their token in the registry instead of the token itself
+        tokenIndex = sp.local("tokenIndex", self.data.nextTokenIndex)
+
+        sp.if self.data.tokenIndexes.contains(token):
+            tokenIndex.value = self.data.tokenIndexes[token]
+        sp.else:
+            for kind, supported in [("tez", self.config.support_tez), ("FA12", self.config.support_FA12), ("FA2", self.config.support_FA2)]:
+                if not supported:
+                    sp.verify(~token.is_variant(kind), message = "TOKEN_NOT_SUPPORTED")
+
+            self.data.tokens[tokenIndex.value] = token
+            self.data.tokenIndexes[token] = tokenIndex.value
+            self.data.nextTokenIndex += 1
+
+        return tokenIndex.value
 
     @sp.sub_entry_point
-    def balanceOfReceiver(self, params):  
-        stream = self.data.streams[params.streamId]
+    def transferToken(self, params):
+        self.sendToken(params)
 
-        receiverBalance = params.timeDifference * stream.ratePerSecond
+    def sendToken(self, params):
+        # the single token movement shared by every entry point, tez is always paid by the contract
+        with params.token.match_cases() as arg:
+            with arg.match("tez") as unit:
+                if self.config.support_tez:
+                    sp.send(params.to_, sp.utils.nat_to_mutez(params.amount))
+                else:
+                    sp.failwith("TOKEN_NOT_SUPPORTED")
+
+            with arg.match("FA12") as FA12_token:
+                if self.config.support_FA12:
+                    c = sp.contract(FA12TransferType, FA12_token, "transfer").open_some()
 
-        sp.if stream.remainingBalance < stream.deposit:
-            withdrawalAmount = sp.as_nat(stream.deposit - stream.remainingBalance)
-            receiverBalance = sp.as_nat(receiverBalance - withdrawalAmount)
+                    data_to_be_sent = sp.record(
+                        from_ = params.from_,
+                        to_ = params.to_,
+                        value = params.amount
+                    )
 
-        sp.result(receiverBalance)
+                    sp.transfer(data_to_be_sent, sp.mutez(0), c)
+                else:
+                    sp.failwith("TOKEN_NOT_SUPPORTED")
 
+            with arg.match("FA2") as FA2_token:
+                if self.config.support_FA2:
+                    c = sp.contract(FA2TransferType, FA2_token.tokenAddress, "transfer").open_some()
 
-    def checkRequester(self, streamId):
-        sp.verify((sp.sender == self.data.streams[streamId].receiver), message = "NOT_RECEIVER")
+                    data_to_be_sent = sp.list(
+                        [
+                            sp.record(
+                                from_ = params.from_, 
+                                txs = sp.list(
+                                    [
+                                        sp.record(
+                                            amount = params.amount,
+                                            to_ = params.to_, 
+                                            token_id = FA2_token.tokenId
+                                        )
+                                    ]
+                                )
+                            )
+                        ]
+                    )
+                    sp.transfer(data_to_be_sent, sp.mutez(0), c)
+                else:
+                    sp.failwith("TOKEN_NOT_SUPPORTED")
 
-    @sp.entry_point
+    def moveToken(self, token, from_, to_, amount):
+        params = sp.record(token = token, from_ = from_, to_ = to_, amount = amount)
+        if self.config.use_sub_entry_points:
+            self.transferToken(params)
+        else:
+            self.sendToken(params)
+
+    def collectDeposit(self, token, amount):
+        sp.if token.is_variant("tez"):
+            sp.verify(sp.amount == sp.utils.nat_to_mutez(amount), message = "INVALID_TEZ")
+        sp.else:
+            self.moveToken(token, sp.sender, sp.self_address, amount)
+
+    @sp.entry_point(lazify = False)
     def createStream(self, params):
+        sp.set_type(params, StreamParams)
+
+        self.checkStartTime(params.startTime)
+        self.checkStopTime(params.startTime, params.stopTime)
+        self.checkRate(params.ratePerSecond)
+        self.checkValidReceiver(params.receiver, sp.sender)
+
+        deposit = sp.local("deposit", self.depositFor(params.startTime, params.stopTime, params.ratePerSecond))
+
+        # transfer tokens
+        self.collectDeposit(params.token, deposit.value)
+        self.addTezDeposit(params.token, deposit.value)
+
+        self.data.streams[self.data.nextStreamId] = self.newStream(
+            ratePerSecond = params.ratePerSecond,
+            startTime = params.startTime,
+            stopTime = params.stopTime,
+            receiver = params.receiver,
+            sender = sp.sender,
+            tokenIndex = self.registerToken(params.token),
+            withdrawn = sp.nat(0),
+        )
+        self.indexStream(self.data.nextStreamId, sp.sender, params.receiver)
+        self.emitEvent("streamCreated", StreamCreatedEvent, sp.record(
+            streamId = self.data.nextStreamId,
+            sender = sp.sender,
+            receiver = params.receiver,
+            token = params.token,
+            deposit = deposit.value,
+            remainingBalance = deposit.value
+        ))
+
+        self.data.nextStreamId = self.data.nextStreamId + 1
+
+    @sp.entry_point
+    def createSegmentedStream(self, params):
         sp.set_type(params, sp.TRecord(
-            ratePerSecond = sp.TNat,
             startTime = sp.TTimestamp,
-            stopTime = sp.TTimestamp,
+            segments = sp.TList(Segment),
             receiver = sp.TAddress,
             token = TokenType
         ))
 
         self.checkStartTime(params.startTime)
-        self.checkStopTime(params.startTime, params.stopTime)
         self.checkValidReceiver(params.receiver, sp.sender)
+        sp.verify((sp.len(params.segments) > 0) & (sp.len(params.segments) <= MAX_SEGMENTS), message = "INVALID_SEGMENTS")
 
-        deposit = sp.local("deposit", self.getDeposit(sp.record(
-                    startTime = params.startTime, 
-                    stopTime = params.stopTime, 
-                    ratePerSecond =  params.ratePerSecond
-                )
-            )
-        )
+        deposit = sp.local("deposit", sp.nat(0))
+        stopTime = sp.local("stopTime", params.startTime)
+
+        sp.for segment in params.segments:
+            self.checkStopTime(stopTime.value, segment.segmentEnd)
+            deposit.value += sp.as_nat(segment.segmentEnd - stopTime.value) * segment.ratePerSecond
+            stopTime.value = segment.segmentEnd
 
         # transfer tokens
-        with params.token.match_cases() as arg:
-            with arg.match("tez") as unit:
-                sp.verify(sp.amount == sp.utils.nat_to_mutez(deposit.value), message = "INVALID_TEZ")
+        self.collectDeposit(params.token, deposit.value)
+        self.addTezDeposit(params.token, deposit.value)
 
-            with arg.match("FA12") as FA12_token:
-                data_type = sp.TRecord(
-                    from_ = sp.TAddress,
-                    to_ = sp.TAddress,
-                    value = sp.TNat
-                ).layout(("from_ as from", ("to_ as to", "value")))
-
-                c = sp.contract(data_type, FA12_token, "transfer").open_some()
-
-                data_to_be_sent = sp.record(
-                    from_ = sp.sender,
-                    to_ = sp.self_address,
-                    value = deposit.value
-                )
+        self.data.streams[self.data.nextStreamId] = self.newStream(
+            ratePerSecond = sp.nat(0),
+            startTime = params.startTime,
+            stopTime = stopTime.value,
+            receiver = params.receiver,
+            sender = sp.sender,
+            tokenIndex = self.registerToken(params.token),
+            withdrawn = sp.nat(0),
+        )
+        self.data.schedules[self.data.nextStreamId] = params.segments
+        self.indexStream(self.data.nextStreamId, sp.sender, params.receiver)
+        self.emitEvent("streamCreated", StreamCreatedEvent, sp.record(
+            streamId = self.data.nextStreamId,
+            sender = sp.sender,
+            receiver = params.receiver,
+            token = params.token,
+            deposit = deposit.value,
+            remainingBalance = deposit.value
+        ))
 
-                sp.transfer(data_to_be_sent, sp.mutez(0), c)
+        self.data.nextStreamId = self.data.nextStreamId + 1
 
-            with arg.match("FA2") as FA2_token:
-                data_type = sp.TList(
-                    sp.TRecord(
-                        from_ = sp.TAddress, 
-                        txs = sp.TList(
-                            sp.TRecord(
-                                amount = sp.TNat,
-                                to_ = sp.TAddress,
-                                token_id = sp.TNat
-                            ).layout(("to_", ("token_id", "amount")))
-                        )
-                    ).layout(("from_", "txs"))
-                )
+    @sp.entry_point
+    def createSplitStream(self, params):
+        # one deposit streamed to several receivers, weighted by their share
+        sp.set_type(params, sp.TRecord(
+            ratePerSecond = sp.TNat,
+            startTime = sp.TTimestamp,
+            stopTime = sp.TTimestamp,
+            receivers = sp.TMap(sp.TAddress, sp.TNat),
+            token = TokenType
+        ))
 
-                c = sp.contract(data_type, FA2_token.tokenAddress, "transfer").open_some()
-
-                data_to_be_sent = sp.list(
-                    [
-                        sp.record(
-                            from_ = sp.sender, 
-                            txs = sp.list(
-                                [
-                                    sp.record(
-                                        amount = deposit.value,
-                                        to_ = sp.self_address, 
-                                        token_id = FA2_token.tokenId
-                                    )
-                                ]
-                            )
-                        )
-                    ]
-                )
-                sp.transfer(data_to_be_sent, sp.mutez(0), c)
+        self.checkStartTime(params.startTime)
+        self.checkStopTime(params.startTime, params.stopTime)
+        self.checkRate(params.ratePerSecond)
+        sp.verify((sp.len(params.receivers) > 0) & (sp.len(params.receivers) <= MAX_SPLIT_RECEIVERS), message = "INVALID_RECEIVERS")
 
+        receivers = sp.local("receivers", sp.map(tkey = sp.TAddress, tvalue = SplitReceiver))
+        totalShares = sp.local("totalShares", sp.nat(0))
 
-        self.data.streams[self.data.nextStreamId] = sp.record(
-            deposit = deposit.value,
+        sp.for receiver in params.receivers.items():
+            self.checkValidReceiver(receiver.key, sp.sender)
+            sp.verify(receiver.value > 0, message = "INVALID_SHARE")
+
+            receivers.value[receiver.key] = sp.record(share = receiver.value, withdrawn = sp.nat(0))
+            totalShares.value += receiver.value
+            self.addToIndex(self.data.streamsByReceiver, receiver.key, self.data.nextStreamId)
+
+        deposit = sp.local("deposit", self.depositFor(params.startTime, params.stopTime, params.ratePerSecond))
+
+        # transfer tokens
+        self.collectDeposit(params.token, deposit.value)
+
+        self.data.splitStreams[self.data.nextStreamId] = sp.record(
             ratePerSecond = params.ratePerSecond,
-            remainingBalance = deposit.value,
             startTime = params.startTime,
             stopTime = params.stopTime,
-            receiver = params.receiver,
             sender = sp.sender,
-            token = params.token,
+            tokenIndex = self.registerToken(params.token),
+            receivers = receivers.value,
+            totalShares = totalShares.value,
+            withdrawn = sp.nat(0),
         )
+        self.addToIndex(self.data.streamsBySender, sp.sender, self.data.nextStreamId)
+        self.emitEvent("splitStreamCreated", SplitStreamCreatedEvent, sp.record(
+            streamId = self.data.nextStreamId,
+            sender = sp.sender,
+            receivers = params.receivers,
+            token = params.token,
+            deposit = deposit.value
+        ))
 
         self.data.nextStreamId = self.data.nextStreamId + 1
 
+    @sp.entry_point(lazify = False)
+    def createStreams(self, params):
+        sp.set_type(params, sp.TList(StreamParams))
+
+        # total deposit owed by the sender, per token
+        deposits = sp.local("deposits", sp.map(tkey = TokenType, tvalue = sp.TNat))
+
+        sp.for stream in params:
+            self.checkStartTime(stream.startTime)
+            self.checkStopTime(stream.startTime, stream.stopTime)
+            self.checkRate(stream.ratePerSecond)
+            self.checkValidReceiver(stream.receiver, sp.sender)
+
+            # stopTime > startTime is checked above, so the deposit is computed inline
+            # instead of paying for a getDeposit call per stream
+            deposit = sp.local("deposit", sp.as_nat(stream.stopTime - stream.startTime) * stream.ratePerSecond).value
+            deposits.value[stream.token] = deposits.value.get(stream.token, 0) + deposit
+
+            self.data.streams[self.data.nextStreamId] = self.newStream(
+                ratePerSecond = stream.ratePerSecond,
+                startTime = stream.startTime,
+                stopTime = stream.stopTime,
+                receiver = stream.receiver,
+                sender = sp.sender,
+                tokenIndex = self.registerToken(stream.token),
+                withdrawn = sp.nat(0),
+            )
+            self.indexStream(self.data.nextStreamId, sp.sender, stream.receiver)
+            self.emitEvent("streamCreated", StreamCreatedEvent, sp.record(
+                streamId = self.data.nextStreamId,
+                sender = sp.sender,
+                receiver = stream.receiver,
+                token = stream.token,
+                deposit = deposit,
+                remainingBalance = deposit
+            ))
+
+            self.data.nextStreamId = self.data.nextStreamId + 1
+
+        self.collectDeposits(deposits)
+
+        if self.config.support_rewards:
+            self.data.tezDeposits += deposits.value.get(sp.variant("tez", sp.unit), 0)
+
+    def collectDeposits(self, deposits):
+        # deposits holds the total owed by the sender per token
+        # the tez sent must cover the tez streams exactly, even when there are none
+        sp.verify(sp.amount == sp.utils.nat_to_mutez(deposits.value.get(sp.variant("tez", sp.unit), 0)), message = "INVALID_TEZ")
+
+        # transfer tokens, one FA1.2 transfer per token and one FA2 transfer per token contract
+        fa2Txs = sp.local("fa2Txs", sp.map(tkey = sp.TAddress, tvalue = sp.TList(FA2TransferTxType)))
+
+        sp.for total in deposits.value.items():
+            with total.key.match_cases() as arg:
+                with arg.match("tez") as unit:
+                    pass
+
+                with arg.match("FA12") as FA12_token:
+                    if self.config.support_FA12:
+                        self.moveToken(total.key, sp.sender, sp.self_address, total.value)
+                    else:
+                        sp.failwith("TOKEN_NOT_SUPPORTED")
+
+                with arg.match("FA2") as FA2_token:
+                    if self.config.support_FA2:
+                        fa2Txs.value[FA2_token.tokenAddress] = sp.cons(
+                            sp.record(
+                                amount = total.value,
+                                to_ = sp.self_address,
+                                token_id = FA2_token.tokenId
+                            ),
+                            fa2Txs.value.get(FA2_token.tokenAddress, sp.list([], t = FA2TransferTxType))
+                        )
+                    else:
+                        sp.failwith("TOKEN_NOT_SUPPORTED")
+
+        if self.config.support_FA2:
+            sp.for batch in fa2Txs.value.items():
+                c = sp.contract(FA2TransferType, batch.key, "transfer").open_some()
+
+                sp.transfer(sp.list([sp.record(from_ = sp.sender, txs = batch.value)]), sp.mutez(0), c)
+
     @sp.entry_point
+    def importStreams(self, params):
+        # streams migrated from a previous deployment keep their schedule and are funded
+        # with what is left of their deposit, the admin sends the funds in the same operation
+
+        sp.set_type(params, sp.TList(ImportedStream))
+
+        sp.verify(sp.sender == self.data.admin, message = "NOT_ADMIN")
+        sp.verify(self.data.importing, message = "IMPORT_FINISHED")
+
+        # total remaining balance of the imported streams, per token
+        deposits = sp.local("deposits", sp.map(tkey = TokenType, tvalue = sp.TNat))
+
+        sp.for imported in params:
+            self.checkStopTime(imported.startTime, imported.stopTime)
+            self.checkValidReceiver(imported.receiver, imported.sender)
+
+            sp.if sp.len(imported.segments) > 0:
+                sp.verify((imported.ratePerSecond == 0) & (sp.len(imported.segments) <= MAX_SEGMENTS), message = "INVALID_SEGMENTS")
+
+                segmentEnd = sp.local("segmentEnd", imported.startTime)
+
+                sp.for segment in imported.segments:
+                    self.checkStopTime(segmentEnd.value, segment.segmentEnd)
+                    segmentEnd.value = segment.segmentEnd
+
+                sp.verify(segmentEnd.value == imported.stopTime, message = "INVALID_SEGMENTS")
+            sp.else:
+                self.checkRate(imported.ratePerSecond)
+
+            stream = sp.local("stream", self.newStream(
+                ratePerSecond = imported.ratePerSecond,
+                startTime = imported.startTime,
+                stopTime = imported.stopTime,
+                receiver = imported.receiver,
+                sender = imported.sender,
+                tokenIndex = self.registerToken(imported.token),
+                withdrawn = sp.nat(0),
+            )).value
+
+            deposit = sp.local("deposit", self.depositOf(stream, imported.segments)).value
+            sp.verify((imported.remainingBalance > 0) & (imported.remainingBalance <= deposit), message = "INVALID_BALANCE")
+
+            # the record keeps the counter of what was already withdrawn on the previous contract
+            stream.withdrawn = sp.as_nat(deposit - imported.remainingBalance)
+            # nothing can have been withdrawn beyond what was streamed by now
+            streamed = sp.local("streamed", self.streamedAmount(stream, imported.segments, self.streamedTime(stream, sp.now))).value
+            sp.verify(stream.withdrawn <= streamed, message = "INVALID_BALANCE")
+            deposits.value[imported.token] = deposits.value.get(imported.token, 0) + imported.remainingBalance
+
+            # the whole deposit is tracked, as it is released in full when the stream ends
+            self.addTezDeposit(imported.token, deposit)
+
+            self.data.streams[self.data.nextStreamId] = stream
+            sp.if sp.len(imported.segments) > 0:
+                self.data.schedules[self.data.nextStreamId] = imported.segments
+            self.indexStream(self.data.nextStreamId, imported.sender, imported.receiver)
+            self.emitEvent("streamCreated", StreamCreatedEvent, sp.record(
+                streamId = self.data.nextStreamId,
+                sender = imported.sender,
+                receiver = imported.receiver,
+                token = imported.token,
+                deposit = deposit,
+                remainingBalance = imported.remainingBalance
+            ))
+
+            self.data.nextStreamId = self.data.nextStreamId + 1
+
+        self.collectDeposits(deposits)
+
+    @sp.entry_point
+    def finishImport(self):
+        # closes importStreams for good
+        sp.verify(sp.sender == self.data.admin, message = "NOT_ADMIN")
+        self.data.importing = False
+
+    def withdrawStream(self, streamId, amount = None):
+        # the receiver is paid right away, without an amount everything streamed so far is paid out
+        self.addWithdrawal(None, sp.sender, streamId, amount)
+
+    @sp.entry_point(lazify = False)
     def withdraw(self, params):
 
         sp.set_type(params, sp.TRecord(
@@ -193,88 +1007,340 @@ class Radiate(sp.Contract):
             amount = sp.TNat
         ))
 
-        self.checkRequester(params.streamId)
-        sp.verify(params.amount > 0, message = "AMOUNT_LESS_THAN_ZERO")   
+        self.withdrawStream(params.streamId, params.amount)
+
+    @sp.entry_point(lazify = False)
+    def withdrawMax(self, params):
+
+        sp.set_type(params, sp.TRecord(
+            streamId = sp.TNat,
+        ))
+
+        self.withdrawStream(params.streamId)
+
+    def newPayouts(self):
+        # amounts owed by the contract, summed per recipient and token so that
+        # each token contract is called once
+        return sp.local("payouts", sp.record(
+            tez = sp.map(tkey = sp.TAddress, tvalue = sp.TNat),
+            FA12 = sp.map(tkey = sp.TPair(sp.TAddress, sp.TAddress), tvalue = sp.TNat),
+            FA2 = sp.map(tkey = sp.TAddress, tvalue = sp.TMap(sp.TPair(sp.TAddress, sp.TNat), sp.TNat))
+        ))
+
+    def addPayout(self, payouts, token, to_, amount):
+        sp.if amount > 0:
+            with token.match_cases() as arg:
+                with arg.match("tez") as unit:
+                    if self.config.support_tez:
+                        payouts.value.tez[to_] = payouts.value.tez.get(to_, 0) + amount
+                    else:
+                        sp.failwith("TOKEN_NOT_SUPPORTED")
+
+                with arg.match("FA12") as FA12_token:
+                    if self.config.support_FA12:
+                        key = sp.pair(FA12_token, to_)
+                        payouts.value.FA12[key] = payouts.value.FA12.get(key, 0) + amount
+                    else:
+                        sp.failwith("TOKEN_NOT_SUPPORTED")
+
+                with arg.match("FA2") as FA2_token:
+                    if self.config.support_FA2:
+                        sp.if ~payouts.value.FA2.contains(FA2_token.tokenAddress):
+                            payouts.value.FA2[FA2_token.tokenAddress] = sp.map()
+
+                        key = sp.pair(to_, FA2_token.tokenId)
+                        payouts.value.FA2[FA2_token.tokenAddress][key] = payouts.value.FA2[FA2_token.tokenAddress].get(key, 0) + amount
+                    else:
+                        sp.failwith("TOKEN_NOT_SUPPORTED")
+
+    def sendPayouts(self, payouts):
+        # payouts of unsupported token kinds are never added, their loops are left out
+        if self.config.support_tez:
+            sp.for payout in payouts.value.tez.items():
+                sp.send(payout.key, sp.utils.nat_to_mutez(payout.value), message = "WITHDRAWAL")
+
+        if self.config.support_FA12:
+            sp.for payout in payouts.value.FA12.items():
+                self.moveToken(sp.variant("FA12", sp.fst(payout.key)), sp.self_address, sp.snd(payout.key), payout.value)
 
-        stream = self.data.streams[params.streamId]
-        timeDiff = self.timeDifference(params.streamId)
+        if self.config.support_FA2:
+            sp.for batch in payouts.value.FA2.items():
+                txs = sp.local("txs", sp.list([], t = FA2TransferTxType))
+
+                sp.for tx in batch.value.items():
+                    txs.value.push(sp.record(
+                        amount = tx.value,
+                        to_ = sp.fst(tx.key),
+                        token_id = sp.snd(tx.key)
+                    ))
+
+                c = sp.contract(FA2TransferType, batch.key, "transfer").open_some()
+
+                sp.transfer(sp.list([sp.record(from_ = sp.self_address, txs = txs.value)]), sp.mutez(0), c)
+
+    def addWithdrawal(self, payouts, receiver, streamId, amount = None):
+        # without payouts the tokens are sent right away, without an amount everything
+        # streamed to the receiver so far is paid out
+        # the stream is read from the big_map once and written back once
+        stream = sp.local("stream", self.data.streams[streamId]).value
+        segments = self.segmentsOf(streamId, stream)
+
+        sp.verify(receiver == stream.receiver, message = "NOT_RECEIVER")
+        if amount is not None:
+            sp.verify(amount > 0, message = "AMOUNT_LESS_THAN_ZERO")
+
+        timeDiff = sp.local("timeDiff", self.elapsedTime(stream)).value
 
         sp.verify(timeDiff > 0, message = "DURATION_0")
 
+        balance = sp.local("balance", self.receiverBalance(stream, segments, timeDiff)).value
+        if amount is None:
+            amount = sp.local("amount", balance).value
+            sp.verify(amount > 0, message = "AMOUNT_LESS_THAN_ZERO")
+        else:
+            # balance should be greater than requested amount
+            sp.verify(balance >= amount, message = "EXCEEDING_AMOUNT")
+
+        stream.withdrawn += amount
+        remainingBalance = sp.local("remainingBalance", self.remainingBalanceOf(stream, segments)).value
+
+        token = sp.local("token", self.data.tokens[stream.tokenIndex]).value
+
+        # token transfer
+        if payouts is None:
+            self.moveToken(token, sp.self_address, receiver, amount)
+        else:
+            self.addPayout(payouts, token, receiver, amount)
+        self.emitEvent("withdrawal", WithdrawalEvent, sp.record(
+            streamId = streamId,
+            receiver = receiver,
+            token = token,
+            amount = amount,
+            remainingBalance = remainingBalance
+        ))
+
+        # if remaining balance becomes 0 then delete stream
+        sp.if remainingBalance == 0:
+            self.payDepletionReward(token, stream, segments, payouts)
+            self.deleteStream(streamId, stream)
+        sp.else:
+            self.data.streams[streamId] = stream
+
+    @sp.entry_point(lazify = False)
+    def withdrawMany(self, params):
+
+        sp.set_type(params, sp.TList(sp.TRecord(
+            streamId = sp.TNat,
+            amount = sp.TNat
+        )))
+
+        payouts = self.newPayouts()
+
+        sp.for withdrawal in params:
+            self.addWithdrawal(payouts, sp.sender, withdrawal.streamId, withdrawal.amount)
+
+        # token transfer
+        self.sendPayouts(payouts)
+
+    @sp.entry_point
+    def withdrawWithPermit(self, params):
+        # withdrawals signed by their receivers and submitted by anyone, each signature
+        # covers the next counter of the receiver so that it cannot be replayed
+
+        sp.set_type(params, sp.TList(Permit))
+
+        payouts = self.newPayouts()
+
+        sp.for permit in params:
+            receiver = sp.local("receiver", sp.to_address(sp.implicit_account(sp.hash_key(permit.publicKey)))).value
+            counter = sp.local("counter", self.data.permitCounters.get(receiver, 0)).value
+
+            sp.verify(
+                sp.check_signature(
+                    permit.publicKey,
+                    permit.signature,
+                    sp.pack(permitPayload(sp.chain_id, sp.self_address, counter, permit.streamId, permit.amount))
+                ),
+                message = "INVALID_SIGNATURE"
+            )
+            self.data.permitCounters[receiver] = counter + 1
+
+            self.addWithdrawal(payouts, receiver, permit.streamId, permit.amount)
+
+        # token transfer
+        self.sendPayouts(payouts)
+
+
+    @sp.entry_point
+    def withdrawSplit(self, params):
+
+        sp.set_type(params, sp.TRecord(
+            streamId = sp.TNat,
+            amount = sp.TNat
+        ))
+
+        stream = sp.local("stream", self.data.splitStreams[params.streamId]).value
+
+        sp.verify(stream.receivers.contains(sp.sender), message = "NOT_RECEIVER")
+        sp.verify(params.amount > 0, message = "AMOUNT_LESS_THAN_ZERO")
+
+        receiver = sp.local("receiver", stream.receivers[sp.sender]).value
+
         # balance should be greater than requested amount
-        balance = self.balanceOfReceiver(sp.record(streamId = params.streamId, timeDifference = timeDiff))
+        balance = self.splitReceiverBalanceOf(stream, receiver, self.streamedTime(stream, sp.now))
         sp.verify(balance >= params.amount, message = "EXCEEDING_AMOUNT")
-        
-        stream.remainingBalance = sp.as_nat(stream.remainingBalance - params.amount)
+
+        receiver.withdrawn += params.amount
+        stream.withdrawn += params.amount
+
+        token = sp.local("token", self.data.tokens[stream.tokenIndex]).value
+        payouts = self.newPayouts()
+
+        self.addPayout(payouts, token, sp.sender, params.amount)
+        self.emitEvent("splitWithdrawal", SplitWithdrawalEvent, sp.record(
+            streamId = params.streamId,
+            receiver = sp.sender,
+            token = token,
+            amount = params.amount,
+            remainingBalance = sp.as_nat(self.splitDepositOf(stream) - stream.withdrawn)
+        ))
+
+        # a receiver paid its whole share leaves the stream
+        sp.if receiver.withdrawn == self.splitDepositOf(stream) * receiver.share / stream.totalShares:
+            del stream.receivers[sp.sender]
+            self.removeFromIndex(self.data.streamsByReceiver, sp.sender, params.streamId)
+        sp.else:
+            stream.receivers[sp.sender] = receiver
+
+        # once every receiver is paid, rounding leftovers go back to the sender
+        sp.if sp.len(stream.receivers) == 0:
+            self.addPayout(payouts, token, stream.sender, sp.as_nat(self.splitDepositOf(stream) - stream.withdrawn))
+            self.removeFromIndex(self.data.streamsBySender, stream.sender, params.streamId)
+            del self.data.splitStreams[params.streamId]
+        sp.else:
+            self.data.splitStreams[params.streamId] = stream
 
         # token transfer
-        with self.data.streams[params.streamId].token.match_cases() as arg:
-            with arg.match("tez") as unit:
-                sp.send(sp.sender, sp.utils.nat_to_mutez(params.amount), message = "WITHDRAWAL")
-
-                sp.if stream.remainingBalance == 0:
-                    reward = sp.local("reward", sp.utils.mutez_to_nat(sp.split_tokens(sp.utils.nat_to_mutez(self.data.rewards), stream.deposit, sp.utils.mutez_to_nat(sp.balance) * 4)))
-                    sp.send(stream.sender, sp.utils.nat_to_mutez(reward.value), message = "YIELD_REWARDS")
-                    sp.send(stream.receiver, sp.utils.nat_to_mutez(reward.value), message = "YIELD_REWARDS")
-                    self.data.rewards = sp.as_nat(self.data.rewards - (reward.value * 2))
-                sp.else:
-                    pass
+        self.sendPayouts(payouts)
 
-            with arg.match("FA12") as FA12_token:
-                data_type = sp.TRecord(
-                    from_ = sp.TAddress,
-                    to_ = sp.TAddress,
-                    value = sp.TNat
-                ).layout(("from_ as from", ("to_ as to", "value")))
-
-                c = sp.contract(data_type, FA12_token, "transfer").open_some()
-
-                data_to_be_sent = sp.record(
-                    from_ = sp.self_address, 
-                    to_ = sp.sender, 
-                    value = params.amount
-                )
+    @sp.entry_point
+    def cancelSplitStream(self, params):
 
-                sp.transfer(data_to_be_sent, sp.mutez(0), c)
+        sp.set_type(params, sp.TRecord(
+            streamId = sp.TNat,
+        ))
 
-            with arg.match("FA2") as FA2_token:
-                data_type = sp.TList(
-                    sp.TRecord(
-                        from_ = sp.TAddress, 
-                        txs = sp.TList(
-                            sp.TRecord(
-                                amount = sp.TNat, 
-                                to_ = sp.TAddress,
-                                token_id = sp.TNat
-                            ).layout(("to_", ("token_id", "amount")))
-                        )
-                    ).layout(("from_", "txs"))
-                )
+        stream = sp.local("stream", self.data.splitStreams[params.streamId]).value
 
-                c = sp.contract(data_type, FA2_token.tokenAddress, "transfer").open_some()
-
-                data_to_be_sent = sp.list(
-                    [
-                        sp.record(
-                            from_ = sp.self_address, 
-                            txs = sp.list(
-                                [
-                                    sp.record(
-                                        amount = params.amount, 
-                                        to_ = sp.sender, 
-                                        token_id = FA2_token.tokenId
-                                    )
-                                ]
-                            )
-                        )
-                    ]
-                )
-                sp.transfer(data_to_be_sent, sp.mutez(0), c)
+        sp.verify(sp.sender == stream.sender, message = "NOT_SENDER")
 
-        # if remaining balance becomes 0 then delete stream
-        sp.if stream.remainingBalance == 0:
-            del stream
+        timeDiff = sp.local("timeDiff", self.streamedTime(stream, sp.now)).value
+        token = sp.local("token", self.data.tokens[stream.tokenIndex]).value
+        payouts = self.newPayouts()
+
+        # receivers get what was streamed to them, the sender gets everything else
+        paid = sp.local("paid", stream.withdrawn)
+        receiverBalances = sp.local("receiverBalances", sp.map(tkey = sp.TAddress, tvalue = sp.TNat))
+
+        sp.for receiver in stream.receivers.items():
+            receiverBalance = sp.local("receiverBalance", self.splitReceiverBalanceOf(stream, receiver.value, timeDiff)).value
+
+            self.addPayout(payouts, token, receiver.key, receiverBalance)
+            paid.value += receiverBalance
+            receiverBalances.value[receiver.key] = receiverBalance
+            self.removeFromIndex(self.data.streamsByReceiver, receiver.key, params.streamId)
+
+        senderBalance = sp.local("senderBalance", sp.as_nat(self.splitDepositOf(stream) - paid.value)).value
+
+        self.addPayout(payouts, token, stream.sender, senderBalance)
+        self.removeFromIndex(self.data.streamsBySender, stream.sender, params.streamId)
+        self.emitEvent("splitStreamCancelled", SplitStreamCancelledEvent, sp.record(
+            streamId = params.streamId,
+            sender = stream.sender,
+            token = token,
+            senderBalance = senderBalance,
+            receiverBalances = receiverBalances.value
+        ))
+
+        del self.data.splitStreams[params.streamId]
+
+        # token transfer
+        self.sendPayouts(payouts)
+
+    @sp.entry_point
+    def extendStream(self, params):
+        # the stream keeps its id, only the extra deposit is pulled from the sender,
+        # finished streams cannot be restarted as the elapsed gap would be paid retroactively
+
+        sp.set_type(params, sp.TRecord(
+            streamId = sp.TNat,
+            newStopTime = sp.TTimestamp
+        ))
+
+        stream = sp.local("stream", self.data.streams[params.streamId]).value
+
+        sp.verify(sp.sender == stream.sender, message = "NOT_SENDER")
+        sp.verify(stream.ratePerSecond != 0, message = "SEGMENTED_STREAM")
+        sp.verify(sp.now < stream.stopTime, message = "STREAM_FINISHED")
+        sp.verify(params.newStopTime > stream.stopTime, message = "STOP_TIME_LESS_THAN_CURRENT_STOP_TIME")
+
+        token = sp.local("token", self.data.tokens[stream.tokenIndex]).value
+        extraDeposit = sp.local("extraDeposit", sp.as_nat(params.newStopTime - stream.stopTime) * stream.ratePerSecond).value
+
+        # transfer tokens
+        self.collectDeposit(token, extraDeposit)
 
+        if self.config.support_rewards:
+            sp.if token.is_variant("tez") & (extraDeposit > 0):
+                # the extra deposit only earns rewards from now on, so the snapshot moves
+                # to the deposit weighted average of the old snapshot and the accumulator,
+                # rounded up so that the stream never accrues more than streamRewards holds
+                deposit = sp.local("deposit", self.depositOf(stream, sp.list([], t = Segment))).value
+                stream.rewardSnapshot = sp.as_nat(deposit * stream.rewardSnapshot + extraDeposit * self.data.rewardPerDeposit + deposit + extraDeposit - 1) / (deposit + extraDeposit)
+                self.data.tezDeposits += extraDeposit
+
+        stream.stopTime = params.newStopTime
+        self.data.streams[params.streamId] = stream
+        self.emitEvent("streamExtended", StreamExtendedEvent, sp.record(
+            streamId = params.streamId,
+            stopTime = params.newStopTime,
+            extraDeposit = extraDeposit
+        ))
+
+    @sp.entry_point
+    def settle(self, params):
+        # anyone can pay out finished streams to their receivers and clear them from storage
+
+        sp.set_type(params, sp.TList(sp.TNat))
+
+        payouts = self.newPayouts()
+
+        sp.for streamId in params:
+            # streams withdrawn to zero in the meantime are already deleted,
+            # streams still running are left for a later call
+            sp.if self.data.streams.contains(streamId):
+                stream = sp.local("stream", self.data.streams[streamId]).value
+
+                sp.if sp.now >= stream.stopTime:
+                    segments = self.segmentsOf(streamId, stream)
+                    token = sp.local("token", self.data.tokens[stream.tokenIndex]).value
+                    receiverBalance = sp.local("receiverBalance", self.remainingBalanceOf(stream, segments)).value
+
+                    self.addPayout(payouts, token, stream.receiver, receiverBalance)
+                    self.emitEvent("streamSettled", StreamSettledEvent, sp.record(
+                        streamId = streamId,
+                        sender = stream.sender,
+                        receiver = stream.receiver,
+                        token = token,
+                        receiverBalance = receiverBalance
+                    ))
+
+                    self.payDepletionReward(token, stream, segments, payouts)
+
+                    self.deleteStream(streamId, stream)
+
+        # token transfer
+        self.sendPayouts(payouts)
 
     @sp.entry_point
     def cancelStream(self, params):
@@ -283,101 +1349,97 @@ class Radiate(sp.Contract):
             streamId = sp.TNat,
         ))
     
+        stream = sp.local("stream", self.data.streams[params.streamId]).value
+        segments = self.segmentsOf(params.streamId, stream)
+
         sp.verify(
-            (sp.sender == self.data.streams[params.streamId].sender) | (sp.sender == self.data.streams[params.streamId].receiver)
+            (sp.sender == stream.sender) | (sp.sender == stream.receiver)
         )
 
-        timeDiff = self.timeDifference(params.streamId)
+        timeDiff = sp.local("timeDiff", self.elapsedTime(stream)).value
 
-        receiverBalance = self.balanceOfReceiver(sp.record(
-                streamId = params.streamId, 
-                timeDifference = timeDiff
-            )
-        )
-        senderBalance = sp.as_nat(self.data.streams[params.streamId].remainingBalance - receiverBalance)
+        receiverBalance = sp.local("receiverBalance", self.receiverBalance(stream, segments, timeDiff)).value
+        senderBalance = sp.local("senderBalance", sp.as_nat(self.remainingBalanceOf(stream, segments) - receiverBalance)).value
 
-        stream = self.data.streams[params.streamId]
+        token = sp.local("token", self.data.tokens[stream.tokenIndex]).value
+
+        # token transfer, zero amounts are left out
+        if self.config.support_FA2:
+            sp.if token.is_variant("FA2"):
+                # both parties are paid by one transfer
+                FA2_token = token.open_variant("FA2")
+                txs = sp.local("txs", sp.list([], t = FA2TransferTxType))
 
-        # token transfer
-        with self.data.streams[params.streamId].token.match_cases() as arg:
-            with arg.match("tez") as unit:
-                sp.send(self.data.streams[params.streamId].sender, sp.utils.nat_to_mutez(senderBalance), message = "CANCELLED")
-                
                 sp.if receiverBalance != 0:
-                    sp.send(self.data.streams[params.streamId].receiver, sp.utils.nat_to_mutez(receiverBalance), message = "CANCELLED")
+                    txs.value.push(sp.record(
+                        amount = receiverBalance,
+                        to_ = stream.receiver,
+                        token_id = FA2_token.tokenId
+                    ))
 
-            with arg.match("FA12") as FA12_token:
-                data_type = sp.TRecord(
-                    from_ = sp.TAddress,
-                    to_ = sp.TAddress,
-                    value = sp.TNat
-                ).layout(("from_ as from", ("to_ as to", "value")))
-
-                c = sp.contract(data_type, FA12_token, "transfer").open_some()
-
-                data_to_be_sent = sp.record(          # sending to sender
-                    from_ = sp.self_address,
-                    to_ = self.data.streams[params.streamId].sender,
-                    value = senderBalance
-                )
-                sp.transfer(data_to_be_sent, sp.mutez(0), c)
+                sp.if senderBalance != 0:
+                    txs.value.push(sp.record(
+                        amount = senderBalance,
+                        to_ = stream.sender,
+                        token_id = FA2_token.tokenId
+                    ))
 
-                data_to_be_sent_receiver = sp.record(       # sending to receiver
-                    from_ = sp.self_address,
-                    to_ = self.data.streams[params.streamId].receiver,
-                    value = receiverBalance
-                )
-                sp.transfer(data_to_be_sent_receiver, sp.mutez(0), c)
+                c = sp.contract(FA2TransferType, FA2_token.tokenAddress, "transfer").open_some()
 
-            with arg.match("FA2") as FA2_token:
-                data_type = sp.TList(
-                    sp.TRecord(
-                        from_ = sp.TAddress, 
-                        txs = sp.TList(
-                            sp.TRecord(amount = sp.TNat,
-                                to_ = sp.TAddress,
-                                token_id = sp.TNat
-                            ).layout(("to_", ("token_id", "amount")))
-                        )
-                    ).layout(("from_", "txs"))
-                )
+                sp.transfer(sp.list([sp.record(from_ = sp.self_address, txs = txs.value)]), sp.mutez(0), c)
+            sp.else:
+                self.sendBalances(token, stream, senderBalance, receiverBalance)
+        else:
+            self.sendBalances(token, stream, senderBalance, receiverBalance)
 
-                c = sp.contract(data_type, FA2_token.tokenAddress, "transfer").open_some()
-
-                data_to_be_sent = sp.list(   # for sender
-                    [
-                        sp.record(
-                            from_ = sp.self_address, 
-                            txs = sp.list(
-                                [
-                                    sp.record(
-                                        amount = senderBalance,
-                                        to_ = self.data.streams[params.streamId].sender,
-                                        token_id = FA2_token.tokenId
-                                    )
-                                ]
-                            )
-                        )
-                    ]
-                )
-                sp.transfer(data_to_be_sent, sp.mutez(0), c)
-
-                data_to_be_sent_receiver = sp.list(      # for receiver
-                    [       
-                        sp.record(
-                            from_ = sp.self_address, 
-                            txs = sp.list(
-                                [
-                                    sp.record(
-                                        amount = receiverBalance,
-                                        to_ = self.data.streams[params.streamId].receiver,
-                                        token_id = FA2_token.tokenId
-                                    )
-                                ]
-                            )
-                        )
-                    ]
-                )
-                sp.transfer(data_to_be_sent_receiver, sp.mutez(0), c)
+        self.removeCancelledStream(params.streamId, stream, segments, token, senderBalance, receiverBalance)
 
-        del self.data.streams[params.streamId]
\ No newline at end of file
+    def sendBalances(self, token, stream, senderBalance, receiverBalance):
+        sp.if senderBalance != 0:
+            self.moveToken(token, sp.self_address, stream.sender, senderBalance)
+
+        sp.if receiverBalance != 0:
+            self.moveToken(token, sp.self_address, stream.receiver, receiverBalance)
+
+    def removeCancelledStream(self, streamId, stream, segments, token, senderBalance, receiverBalance):
+        self.cancelTezDeposit(token, stream, segments)
+        self.emitEvent("streamCancelled", StreamCancelledEvent, sp.record(
+            streamId = streamId,
+            sender = stream.sender,
+            receiver = stream.receiver,
+            token = token,
+            senderBalance = senderBalance,
+            receiverBalance = receiverBalance
+        ))
+
+        self.deleteStream(streamId, stream)
+
+    @sp.entry_point
+    def cancelStreams(self, params):
+        # the payouts of all the cancelled streams are summed before being transferred
+
+        sp.set_type(params, sp.TList(sp.TNat))
+
+        payouts = self.newPayouts()
+
+        sp.for streamId in params:
+            stream = sp.local("stream", self.data.streams[streamId]).value
+
+            sp.verify(
+                (sp.sender == stream.sender) | (sp.sender == stream.receiver)
+            )
+
+            segments = self.segmentsOf(streamId, stream)
+
+            receiverBalance = sp.local("receiverBalance", self.receiverBalance(stream, segments, self.elapsedTime(stream))).value
+            senderBalance = sp.local("senderBalance", sp.as_nat(self.remainingBalanceOf(stream, segments) - receiverBalance)).value
+
+            token = sp.local("token", self.data.tokens[stream.tokenIndex]).value
+
+            self.addPayout(payouts, token, stream.receiver, receiverBalance)
+            self.addPayout(payouts, token, stream.sender, senderBalance)
+
+            self.removeCancelledStream(streamId, stream, segments, token, senderBalance, receiverBalance)
+
+        # token transfer
+        self.sendPayouts(payouts)
\ No newline at end of file
@@ -1,6 +1,13 @@
+import types
+
 import smartpy as sp
 
-Radiate = sp.io.import_script_from_url("file:smart_contracts/contract.py").Radiate
+Radiate_module = sp.io.import_script_from_url("file:smart_contracts/contract.py")
+Radiate = Radiate_module.Radiate
+Radiate_config = Radiate_module.Radiate_config
+
+Segment = Radiate_module.Segment
+permitPayload = Radiate_module.permitPayload
 
 FA12_module = sp.io.import_script_from_url("https://smartpy.io/dev/templates/FA1.2.py")
 FA12 = FA12_module.FA12
@@ -11,6 +18,98 @@ FA2 = FA2_module.FA2
 FA2_config = FA2_module.FA2_config
 
 
+class ViewContext:
+    # the contract as seen by an off-chain view, its helpers read the storage given to compute
+    def __init__(self, contract, data):
+        self.contract = contract
+        self.data = data
+
+    def __getattr__(self, name):
+        f = type(self.contract).__dict__.get(name)
+        if isinstance(f, types.FunctionType):
+            return types.MethodType(f, self)
+        return getattr(self.contract, name)
+
+
+class TestOffchainView(sp.Contract):
+    def __init__(self, contract, f):
+        self.contract = contract
+        self.f = f.f
+        self.init(result = sp.none)
+
+    @sp.entry_point
+    def compute(self, data, params):
+        b = sp.bind_block()
+        with b:
+            self.f(ViewContext(self.contract, data), params)
+        self.data.result = sp.some(b.value)
+
+
+# Creating test accounts
+admin = sp.test_account("admin").address
+alice = sp.test_account("alice").address
+bob = sp.test_account("bob").address
+user1 = sp.test_account("user1")
+user2 = sp.test_account("user2")
+
+tez = sp.variant("tez", sp.unit)
+
+def FA12Token(c2):
+    return sp.variant("FA12", c2.address)
+
+def FA2Token(c3):
+    return sp.variant("FA2", sp.record(tokenAddress = c3.address, tokenId = 0))
+
+def setup(title, config = Radiate_config()):
+    # a Radiate contract, an FA1.2 and an FA2 token, user1 holds both tokens and
+    # Radiate can move them
+    scenario = sp.test_scenario()
+    scenario.add_flag("default_record_layout", "comb")
+    scenario.h1(title)
+    scenario.table_of_contents()
+
+    scenario.h2("Initialise the contracts")
+    c1 = Radiate(admin = admin, config = config)
+    scenario += c1
+
+    c2 = FA12(
+            admin,
+            config              = FA12_config(support_upgradable_metadata = True),
+            token_metadata      = {"decimals" : "18", "name" : "Test FA1.2 Token", "symbol" : "MGT"},
+            contract_metadata   = {"" : "ipfs://QmaiAUj1FFNGYTu8rLBjc3eeN9cSKwaF8EGMBNDmhzPNFd"}
+        )
+    scenario += c2
+
+    c3 = FA2(
+        config = FA2_config(non_fungible = False),
+        metadata = sp.utils.metadata_of_url("https://example.com"),
+        admin = admin
+    )
+    scenario += c3
+
+    c2.mint(address = user1.address, value = 100000).run(sender = admin)
+    c2.approve(spender = c1.address, value = 100000).run(sender = user1)
+
+    c3.mint(
+        address = user1.address,
+        amount = 100000,
+        metadata = FA2.make_metadata(name = "The Token Zero", decimals = 18, symbol = "TK0"),
+        token_id = 0
+    ).run(sender = admin)
+
+    c3.update_operators(
+        [
+            sp.variant("add_operator", c3.operator_param.make(
+                owner = user1.address,
+                operator = c1.address,
+                token_id = 0
+            ))
+        ]
+    ).run(sender = admin)
+
+    return scenario, c1, c2, c3
+
+
 @sp.add_test(name = "Radiate", is_default = True)
 def test():
     scenario = sp.test_scenario()
@@ -234,5 +333,889 @@ def test():
     
 
 
+@sp.add_test(name = "Radiate batches")
+def test():
+    scenario, c1, c2, c3 = setup("Radiate batched creation and withdrawal")
+
+    ######################################### batch creation begins here #####################################
+
+    scenario.h2("Creating streams in a batch")
+    batch = [
+        sp.record(
+            ratePerSecond = sp.nat(1),
+            startTime = sp.timestamp(2000),
+            stopTime = sp.timestamp(3000),
+            receiver = user2.address,
+            token = tez
+        ),
+        sp.record(
+            ratePerSecond = sp.nat(10),
+            startTime = sp.timestamp(2000),
+            stopTime = sp.timestamp(3000),
+            receiver = user2.address,
+            token = FA12Token(c2)
+        ),
+        sp.record(
+            ratePerSecond = sp.nat(5),
+            startTime = sp.timestamp(2000),
+            stopTime = sp.timestamp(4000),
+            receiver = bob,
+            token = FA12Token(c2)
+        ),
+        sp.record(
+            ratePerSecond = sp.nat(10),
+            startTime = sp.timestamp(2000),
+            stopTime = sp.timestamp(3000),
+            receiver = user2.address,
+            token = FA2Token(c3)
+        )
+    ]
+
+    scenario.h3("Failing case, tez amount does not match the tez streams")
+    c1.createStreams(batch).run(sender = user1, amount = sp.mutez(10), now = sp.timestamp(1500), valid = False)
+
+    scenario.h3("Creating tez, FA1.2 and FA2 streams in one call")
+    c1.createStreams(batch).run(sender = user1, amount = sp.mutez(1000), now = sp.timestamp(1500))
+
+    scenario.verify(c1.data.nextStreamId == 4)
+    scenario.verify(c1.data.streams[0].withdrawn == 0)
+    scenario.verify(~c1.data.schedules.contains(0))
+    scenario.verify(c1.data.streams[2].receiver == bob)
+    scenario.verify(c1.data.streams[2].withdrawn == 0)
+    scenario.verify(c1.data.streams[3].sender == user1.address)
+    scenario.verify(c2.data.balances[c1.address].balance == 20000)
+
+    ######################################### batch withdrawal begins here #####################################
+
+    scenario.h2("Withdrawing from several streams in one call")
+    scenario.h3("Failing case, one of the streams belongs to another receiver")
+    c1.withdrawMany([
+        sp.record(streamId = 0, amount = 100),
+        sp.record(streamId = 2, amount = 100)
+    ]).run(sender = user2, now = sp.timestamp(2500), valid = False)
+
+    scenario.h3("Failing case, amount exceeds the streamed balance")
+    c1.withdrawMany([
+        sp.record(streamId = 0, amount = 100),
+        sp.record(streamId = 1, amount = 6000)
+    ]).run(sender = user2, now = sp.timestamp(2500), valid = False)
+
+    scenario.h3("Withdrawing from tez, FA1.2 and FA2 streams")
+    c1.withdrawMany([
+        sp.record(streamId = 0, amount = 100),
+        sp.record(streamId = 1, amount = 1000),
+        sp.record(streamId = 3, amount = 500)
+    ]).run(sender = user2, now = sp.timestamp(2500))
+
+    scenario.verify(c1.data.streams[0].withdrawn == 100)
+    scenario.verify(c1.data.streams[1].withdrawn == 1000)
+    scenario.verify(c1.data.streams[3].withdrawn == 500)
+    scenario.verify(c2.data.balances[user2.address].balance == 1000)
+
+    ######################################### withdraw max begins here #####################################
+
+    scenario.h2("Withdrawing the whole streamed balance")
+    scenario.h3("Failing case, not the receiver")
+    c1.withdrawMax(streamId = 2).run(sender = user2, now = sp.timestamp(2600), valid = False)
+
+    scenario.h3("Failing case, nothing streamed yet")
+    c1.withdrawMax(streamId = 2).run(sender = bob, now = sp.timestamp(1900), valid = False)
+
+    scenario.h3("Withdrawing everything streamed up to now")
+    c1.withdrawMax(streamId = 2).run(sender = bob, now = sp.timestamp(2600))
+    scenario.verify(c1.data.streams[2].withdrawn == 3000)
+
+    scenario.h3("Failing case, balance already withdrawn at this time")
+    c1.withdrawMax(streamId = 2).run(sender = bob, now = sp.timestamp(2600), valid = False)
+
+    ######################################### single read paths begin here #####################################
+
+    scenario.h2("Withdraw and cancel per token path")
+    scenario.p("The stream record is read once per call; run these calls against the compiled contract to compare consumed gas per path.")
+
+    scenario.h3("Withdraw, tez")
+    c1.withdraw(streamId = 0, amount = 100).run(sender = user2, now = sp.timestamp(2700))
+    scenario.h3("Withdraw, FA1.2")
+    c1.withdraw(streamId = 1, amount = 100).run(sender = user2, now = sp.timestamp(2700))
+    scenario.h3("Withdraw, FA2")
+    c1.withdraw(streamId = 3, amount = 100).run(sender = user2, now = sp.timestamp(2700))
+
+    scenario.verify(c1.data.streams[0].withdrawn == 200)
+    scenario.verify(c1.data.streams[1].withdrawn == 1100)
+    scenario.verify(c1.data.streams[3].withdrawn == 600)
+
+    scenario.h3("Cancel, tez")
+    c1.cancelStream(streamId = 0).run(sender = user1, now = sp.timestamp(2800))
+    scenario.h3("Cancel, FA1.2")
+    c1.cancelStream(streamId = 1).run(sender = user1, now = sp.timestamp(2800))
+    scenario.h3("Cancel, FA2")
+    c1.cancelStream(streamId = 3).run(sender = user1, now = sp.timestamp(2800))
+
+    scenario.verify(~c1.data.streams.contains(0))
+    scenario.verify(~c1.data.streams.contains(1))
+    scenario.verify(~c1.data.streams.contains(3))
+    scenario.verify(c2.data.balances[user2.address].balance == 8000)
+
+    ######################################### views begin here #####################################
+
+    scenario.h2("On-chain views")
+    scenario.verify(c1.getStream(2).receiver == bob)
+    scenario.verify(c1.getStream(2).withdrawn == 3000)
+    scenario.verify(c1.balanceOf(sp.record(streamId = 2, who = admin)) == 0)
+
+    ######################################### address indexes begin here #####################################
+
+    scenario.h2("Streams indexed by address")
+    scenario.verify(c1.data.streamsBySender[user1.address].contains(2))
+    scenario.verify(c1.data.streamsByReceiver[bob].contains(2))
+    scenario.verify(~c1.data.streamsBySender[user1.address].contains(3))
+
+    scenario.h3("Cancelled streams leave the indexes")
+    c1.cancelStream(streamId = 2).run(sender = bob, now = sp.timestamp(2900))
+    scenario.verify(~c1.data.streamsByReceiver.contains(bob))
+    scenario.verify(~c1.data.streamsBySender.contains(user1.address))
+
+    ######################################### token registry begins here #####################################
+
+    scenario.h2("Token registry")
+    scenario.verify(c1.data.nextTokenIndex == 3)
+    scenario.verify(c1.data.tokenIndexes[tez] == 0)
+    scenario.verify(c1.data.tokenIndexes[FA12Token(c2)] == 1)
+    scenario.verify(c1.data.tokens[2] == FA2Token(c3))
+
+
+@sp.add_test(name = "Radiate storage")
+def test():
+    scenario, c1, c2, c3 = setup("Radiate storage footprint")
+
+    ######################################### stream record size begins here #####################################
+
+    scenario.h2("Stream record size")
+    legacyStream = sp.record(
+        deposit = sp.nat(10000),
+        ratePerSecond = sp.nat(10),
+        remainingBalance = sp.nat(9000),
+        startTime = sp.timestamp(2000),
+        stopTime = sp.timestamp(3000),
+        receiver = user2.address,
+        sender = user1.address,
+        token = FA2Token(c3)
+    )
+    compactStream = sp.record(
+        ratePerSecond = sp.nat(10),
+        startTime = sp.timestamp(2000),
+        stopTime = sp.timestamp(3000),
+        receiver = user2.address,
+        sender = user1.address,
+        tokenIndex = sp.nat(2),
+        withdrawn = sp.nat(1000),
+        rewardSnapshot = sp.nat(0)
+    )
+    scenario.h3("Packed size of the previous stream record")
+    scenario.show(sp.len(sp.pack(legacyStream)))
+    scenario.h3("Packed size of the compact stream record")
+    scenario.show(sp.len(sp.pack(compactStream)))
+    scenario.verify(sp.len(sp.pack(compactStream)) < sp.len(sp.pack(legacyStream)))
+
+    ######################################### storage accounting begins here #####################################
+
+    scenario.h2("Depleted streams are removed from storage")
+    for cycle in range(2):
+        scenario.h3("Create and withdraw to zero, cycle %d" % cycle)
+        c1.createStream(
+            ratePerSecond = sp.nat(1),
+            startTime = sp.timestamp(3100),
+            stopTime = sp.timestamp(3200),
+            receiver = user2.address,
+            token = tez
+        ).run(sender = alice, amount = sp.mutez(100), now = sp.timestamp(3050))
+        scenario.verify(c1.data.streams.contains(cycle))
+
+        c1.withdrawMax(streamId = cycle).run(sender = user2, now = sp.timestamp(3300))
+
+        scenario.verify(~c1.data.streams.contains(cycle))
+        scenario.verify(~c1.data.streamsBySender.contains(alice))
+        scenario.verify(~c1.data.streamsByReceiver.contains(user2.address))
+
+        scenario.h4("Storage after cycle %d" % cycle)
+        scenario.show(c1.data)
+
+
+@sp.add_test(name = "Radiate settle")
+def test():
+    scenario, c1, c2, c3 = setup("Radiate settlement of finished streams")
+
+    ######################################### settlement begins here #####################################
+
+    scenario.h2("Settling finished streams")
+    c1.createStreams([
+        sp.record(
+            ratePerSecond = sp.nat(1),
+            startTime = sp.timestamp(3400),
+            stopTime = sp.timestamp(3500),
+            receiver = user2.address,
+            token = tez
+        ),
+        sp.record(
+            ratePerSecond = sp.nat(2),
+            startTime = sp.timestamp(3400),
+            stopTime = sp.timestamp(3500),
+            receiver = bob,
+            token = FA2Token(c3)
+        ),
+        sp.record(
+            ratePerSecond = sp.nat(1),
+            startTime = sp.timestamp(3400),
+            stopTime = sp.timestamp(4000),
+            receiver = bob,
+            token = FA2Token(c3)
+        )
+    ]).run(sender = user1, amount = sp.mutez(100), now = sp.timestamp(3350))
+
+    c1.withdraw(streamId = 0, amount = 20).run(sender = user2, now = sp.timestamp(3450))
+
+    scenario.h3("Streams still running are skipped")
+    c1.settle([0, 1]).run(sender = admin, now = sp.timestamp(3450))
+    scenario.verify(c1.data.streams.contains(0))
+    scenario.verify(c1.data.streams.contains(1))
+
+    scenario.h3("Anyone settles the finished streams, the running one stays")
+    c1.settle([0, 1, 2]).run(sender = admin, now = sp.timestamp(3600))
+    scenario.verify(~c1.data.streams.contains(0))
+    scenario.verify(~c1.data.streams.contains(1))
+    scenario.verify(c1.data.streams.contains(2))
+    scenario.verify(c1.data.streamsByReceiver[bob].contains(2))
+    scenario.verify(~c1.data.streamsByReceiver[bob].contains(1))
+    scenario.verify(c3.data.ledger[c3.ledger_key.make(bob, 0)].balance == 200)
+
+    scenario.h3("Settled streams are skipped")
+    c1.settle([0]).run(sender = admin, now = sp.timestamp(3700))
+
+
+@sp.add_test(name = "Radiate cancel and extend")
+def test():
+    scenario, c1, c2, c3 = setup("Radiate cancellation and extension")
+
+    ######################################### cancellation transfers begin here #####################################
+
+    scenario.h2("Cancelling before the start pays only the sender")
+    c1.createStream(
+        ratePerSecond = sp.nat(3),
+        startTime = sp.timestamp(4000),
+        stopTime = sp.timestamp(4100),
+        receiver = user2.address,
+        token = FA2Token(c3)
+    ).run(sender = user1, now = sp.timestamp(3900))
+
+    c1.cancelStream(streamId = 0).run(sender = user1, now = sp.timestamp(3950))
+    scenario.verify(~c1.data.streams.contains(0))
+    scenario.verify(c3.data.ledger[c3.ledger_key.make(user1.address, 0)].balance == 100000)
+
+    ######################################### extension begins here #####################################
+
+    scenario.h2("Extending a running stream")
+    c1.createStream(
+        ratePerSecond = sp.nat(1),
+        startTime = sp.timestamp(4200),
+        stopTime = sp.timestamp(4300),
+        receiver = user2.address,
+        token = FA2Token(c3)
+    ).run(sender = user1, now = sp.timestamp(4150))
+
+    scenario.h3("Failing case, only the sender can extend")
+    c1.extendStream(streamId = 1, newStopTime = sp.timestamp(4400)).run(sender = user2, now = sp.timestamp(4250), valid = False)
+
+    scenario.h3("Failing case, the new stop time must be later")
+    c1.extendStream(streamId = 1, newStopTime = sp.timestamp(4300)).run(sender = user1, now = sp.timestamp(4250), valid = False)
+
+    scenario.h3("Extending by 100 seconds")
+    c1.extendStream(streamId = 1, newStopTime = sp.timestamp(4400)).run(sender = user1, now = sp.timestamp(4250))
+    scenario.verify(c1.data.streams[1].stopTime == sp.timestamp(4400))
+
+    c1.withdrawMax(streamId = 1).run(sender = user2, now = sp.timestamp(4350))
+    scenario.verify(c1.data.streams[1].withdrawn == 150)
+
+    scenario.h3("Failing case, a finished stream cannot be extended")
+    c1.extendStream(streamId = 1, newStopTime = sp.timestamp(4600)).run(sender = user1, now = sp.timestamp(4400), valid = False)
+    scenario.verify(c1.data.streams[1].stopTime == sp.timestamp(4400))
+
+
+@sp.add_test(name = "Radiate segmented streams")
+def test():
+    scenario, c1, c2, c3 = setup("Radiate piecewise schedules")
+
+    ######################################### piecewise schedules begin here #####################################
+
+    scenario.h2("Piecewise schedule with a cliff")
+    scenario.p("Nothing streams for 100 seconds, 50 tokens unlock at the cliff, then 1 token per second.")
+
+    scenario.h3("Failing case, segment ends must increase")
+    c1.createSegmentedStream(
+        startTime = sp.timestamp(4500),
+        segments = [
+            sp.record(segmentEnd = sp.timestamp(4600), ratePerSecond = sp.nat(0)),
+            sp.record(segmentEnd = sp.timestamp(4600), ratePerSecond = sp.nat(50))
+        ],
+        receiver = user2.address,
+        token = FA2Token(c3)
+    ).run(sender = user1, now = sp.timestamp(4450), valid = False)
 
+    c1.createSegmentedStream(
+        startTime = sp.timestamp(4500),
+        segments = [
+            sp.record(segmentEnd = sp.timestamp(4600), ratePerSecond = sp.nat(0)),
+            sp.record(segmentEnd = sp.timestamp(4601), ratePerSecond = sp.nat(50)),
+            sp.record(segmentEnd = sp.timestamp(4700), ratePerSecond = sp.nat(1))
+        ],
+        receiver = user2.address,
+        token = FA2Token(c3)
+    ).run(sender = user1, now = sp.timestamp(4450))
+    scenario.verify(c1.data.streams[0].stopTime == sp.timestamp(4700))
+    scenario.verify(sp.len(c1.data.schedules[0]) == 3)
+    scenario.verify(sp.len(c1.getSchedule(0)) == 3)
+
+    scenario.h3("Failing case, nothing streamed before the cliff")
+    c1.withdrawMax(streamId = 0).run(sender = user2, now = sp.timestamp(4550), valid = False)
+
+    scenario.h3("Withdrawing after the cliff")
+    c1.withdrawMax(streamId = 0).run(sender = user2, now = sp.timestamp(4650))
+    scenario.verify(c1.data.streams[0].withdrawn == 99)
+    scenario.verify(c1.balanceOf(sp.record(streamId = 0, who = admin)) == 0)
+
+    scenario.h3("Segmented streams cannot be extended")
+    c1.extendStream(streamId = 0, newStopTime = sp.timestamp(4800)).run(sender = user1, now = sp.timestamp(4650), valid = False)
+
+    scenario.h3("Cancelling splits the balance along the schedule")
+    c1.cancelStream(streamId = 0).run(sender = user1, now = sp.timestamp(4680))
+    scenario.verify(~c1.data.streams.contains(0))
+    scenario.verify(~c1.data.schedules.contains(0))
+    scenario.verify(c3.data.ledger[c3.ledger_key.make(user2.address, 0)].balance == 129)
+
+    scenario.h3("Failing cases, a zero rate is reserved for segmented streams")
+    c1.createStream(
+        ratePerSecond = sp.nat(0),
+        startTime = sp.timestamp(4800),
+        stopTime = sp.timestamp(4900),
+        receiver = user2.address,
+        token = FA2Token(c3)
+    ).run(sender = user1, now = sp.timestamp(4700), valid = False)
+
+    c1.createStreams([
+        sp.record(
+            ratePerSecond = sp.nat(0),
+            startTime = sp.timestamp(4800),
+            stopTime = sp.timestamp(4900),
+            receiver = user2.address,
+            token = FA2Token(c3)
+        )
+    ]).run(sender = user1, now = sp.timestamp(4700), valid = False)
+
+    c1.createSplitStream(
+        ratePerSecond = sp.nat(0),
+        startTime = sp.timestamp(4800),
+        stopTime = sp.timestamp(4900),
+        receivers = {user2.address: 1, bob: 1},
+        token = FA2Token(c3)
+    ).run(sender = user1, now = sp.timestamp(4700), valid = False)
+
+
+@sp.add_test(name = "Radiate split streams")
+def test():
+    scenario, c1, c2, c3 = setup("Radiate split streams")
+
+    ######################################### split streams begin here #####################################
+
+    scenario.h2("Split streams")
+    scenario.h3("Failing case, the sender cannot be a receiver")
+    c1.createSplitStream(
+        ratePerSecond = sp.nat(3),
+        startTime = sp.timestamp(5000),
+        stopTime = sp.timestamp(5100),
+        receivers = {user2.address: 1, user1.address: 2},
+        token = FA2Token(c3)
+    ).run(sender = user1, now = sp.timestamp(4900), valid = False)
+
+    c1.createSplitStream(
+        ratePerSecond = sp.nat(3),
+        startTime = sp.timestamp(5000),
+        stopTime = sp.timestamp(5100),
+        receivers = {user2.address: 1, bob: 2},
+        token = FA2Token(c3)
+    ).run(sender = user1, now = sp.timestamp(4900))
+    scenario.verify(c1.data.splitStreams[0].totalShares == 3)
+    scenario.verify(c1.data.streamsByReceiver[bob].contains(0))
+
+    scenario.h3("Failing case, withdrawing more than the receiver's share")
+    c1.withdrawSplit(streamId = 0, amount = 101).run(sender = bob, now = sp.timestamp(5050), valid = False)
+
+    scenario.h3("Receivers withdraw their pro-rata share")
+    c1.withdrawSplit(streamId = 0, amount = 100).run(sender = bob, now = sp.timestamp(5050))
+    c1.withdrawSplit(streamId = 0, amount = 100).run(sender = user2, now = sp.timestamp(5100))
+    scenario.verify(~c1.data.splitStreams[0].receivers.contains(user2.address))
+
+    scenario.h3("The last withdrawal clears the stream")
+    c1.withdrawSplit(streamId = 0, amount = 100).run(sender = bob, now = sp.timestamp(5200))
+    scenario.verify(~c1.data.splitStreams.contains(0))
+    scenario.verify(~c1.data.streamsByReceiver.contains(bob))
+
+    scenario.h3("Cancelling a split stream")
+    c1.createSplitStream(
+        ratePerSecond = sp.nat(4),
+        startTime = sp.timestamp(5300),
+        stopTime = sp.timestamp(5400),
+        receivers = {user2.address: 1, bob: 1},
+        token = FA2Token(c3)
+    ).run(sender = user1, now = sp.timestamp(5250))
+
+    c1.cancelSplitStream(streamId = 1).run(sender = bob, now = sp.timestamp(5350), valid = False)
+    c1.cancelSplitStream(streamId = 1).run(sender = user1, now = sp.timestamp(5350))
+    scenario.verify(~c1.data.splitStreams.contains(1))
+    scenario.verify(c3.data.ledger[c3.ledger_key.make(bob, 0)].balance == 300)
+
+
+@sp.add_test(name = "Radiate rewards")
+def test():
+    scenario, c1, c2, c3 = setup("Radiate rewards of tez streams")
+
+    ######################################### rewards begin here #####################################
+
+    scenario.h2("Rewards of tez streams")
+    c1.createStream(
+        ratePerSecond = sp.nat(10),
+        startTime = sp.timestamp(6000),
+        stopTime = sp.timestamp(6100),
+        receiver = user2.address,
+        token = tez
+    ).run(sender = alice, amount = sp.mutez(1000), now = sp.timestamp(5900))
+    scenario.verify(c1.data.tezDeposits == 1000)
+
+    c1.createStream(
+        ratePerSecond = sp.nat(10),
+        startTime = sp.timestamp(6000),
+        stopTime = sp.timestamp(6100),
+        receiver = bob,
+        token = tez
+    ).run(sender = alice, amount = sp.mutez(1000), now = sp.timestamp(5900))
+    scenario.verify(c1.data.tezDeposits == 2000)
+
+    scenario.h3("Baking rewards reach the contract, half of them for the parties of tez streams")
+    c1.ep().run(sender = admin, amount = sp.mutez(8000))
+    scenario.verify(c1.data.rewardPerDeposit == 1000000000000)
+    scenario.verify(c1.data.streamRewards == 4000)
+    scenario.verify(c1.data.rewards == 4000)
+
+    scenario.h3("The admin cannot collect the parties' share")
+    c1.collect_management_rewards(address = admin, amount = 4001).run(sender = admin, valid = False)
+    c1.collect_management_rewards(address = admin, amount = 500).run(sender = bob, valid = False)
+    c1.collect_management_rewards(address = admin, amount = 4000).run(sender = admin)
+    scenario.verify(c1.data.rewards == 0)
+
+    scenario.h3("Depleting a stream pays both parties a quarter of the rewards")
+    c1.withdrawMax(streamId = 0).run(sender = user2, now = sp.timestamp(6200))
+    scenario.verify(c1.data.streamRewards == 2000)
+    scenario.verify(c1.data.tezDeposits == 1000)
+
+    scenario.h3("Cancelling forfeits the accrued rewards to the admin")
+    c1.cancelStream(streamId = 1).run(sender = alice, now = sp.timestamp(6050))
+    scenario.verify(c1.data.streamRewards == 0)
+    scenario.verify(c1.data.rewards == 2000)
+    scenario.verify(c1.data.tezDeposits == 0)
+
+    scenario.h3("Without tez streams the admin keeps all of the rewards")
+    c1.ep().run(sender = admin, amount = sp.mutez(100))
+    scenario.verify(c1.data.rewards == 2100)
+    scenario.verify(c1.data.streamRewards == 0)
+
+
+@sp.add_test(name = "Radiate events")
+def test():
+    scenario, c1, c2, c3 = setup("Radiate events")
+
+    ######################################### events begin here #####################################
+
+    scenario.h2("Events")
+    scenario.p("Each step below emits the typed events named in its title. The scenario only checks the storage, the payloads in the titles are the expected ones and are not asserted.")
+
+    scenario.h3("streamCreated: streamId 0, alice to user2, tez, deposit 100, remainingBalance 100")
+    c1.createStream(
+        ratePerSecond = sp.nat(1),
+        startTime = sp.timestamp(7000),
+        stopTime = sp.timestamp(7100),
+        receiver = user2.address,
+        token = tez
+    ).run(sender = alice, amount = sp.mutez(100), now = sp.timestamp(6900))
+
+    scenario.h3("withdrawal: streamId 0, amount 30, remainingBalance 70")
+    c1.withdraw(streamId = 0, amount = 30).run(sender = user2, now = sp.timestamp(7030))
+    scenario.verify(c1.data.streams[0].withdrawn == 30)
+
+    scenario.h3("streamCancelled: streamId 0, senderBalance 50, receiverBalance 20")
+    c1.cancelStream(streamId = 0).run(sender = alice, now = sp.timestamp(7050))
+    scenario.verify(~c1.data.streams.contains(0))
+
+    scenario.h3("streamCreated twice: streamIds 1 and 2, user1 to user2 and bob, FA2, deposits 100")
+    c1.createStreams([
+        sp.record(
+            ratePerSecond = sp.nat(1),
+            startTime = sp.timestamp(7200),
+            stopTime = sp.timestamp(7300),
+            receiver = user2.address,
+            token = FA2Token(c3)
+        ),
+        sp.record(
+            ratePerSecond = sp.nat(1),
+            startTime = sp.timestamp(7200),
+            stopTime = sp.timestamp(7300),
+            receiver = bob,
+            token = FA2Token(c3)
+        )
+    ]).run(sender = user1, now = sp.timestamp(7100))
+    scenario.verify(c1.data.nextStreamId == 3)
+
+    scenario.h3("streamExtended: streamId 1, stopTime 7400, extraDeposit 100")
+    c1.extendStream(streamId = 1, newStopTime = sp.timestamp(7400)).run(sender = user1, now = sp.timestamp(7250))
+    scenario.verify(c1.data.streams[1].stopTime == sp.timestamp(7400))
+
+    scenario.h3("streamSettled: streamId 2, receiverBalance 100")
+    c1.settle([1, 2]).run(sender = admin, now = sp.timestamp(7300))
+    scenario.verify(c1.data.streams.contains(1))
+    scenario.verify(~c1.data.streams.contains(2))
+
+    scenario.h3("streamCreated: streamId 3, segmented, FA2, deposit 100")
+    c1.createSegmentedStream(
+        startTime = sp.timestamp(7400),
+        segments = [sp.record(segmentEnd = sp.timestamp(7500), ratePerSecond = sp.nat(1))],
+        receiver = user2.address,
+        token = FA2Token(c3)
+    ).run(sender = user1, now = sp.timestamp(7300))
+
+    scenario.h3("splitStreamCreated: streamId 4, user2 and bob with one share each, FA2, deposit 200")
+    c1.createSplitStream(
+        ratePerSecond = sp.nat(2),
+        startTime = sp.timestamp(7400),
+        stopTime = sp.timestamp(7500),
+        receivers = {user2.address: 1, bob: 1},
+        token = FA2Token(c3)
+    ).run(sender = user1, now = sp.timestamp(7300))
+
+    scenario.h3("splitWithdrawal: streamId 4, bob, amount 40, remainingBalance 160")
+    c1.withdrawSplit(streamId = 4, amount = 40).run(sender = bob, now = sp.timestamp(7450))
+
+    scenario.h3("splitStreamCancelled: streamId 4, senderBalance 100, user2 50 and bob 10")
+    c1.cancelSplitStream(streamId = 4).run(sender = user1, now = sp.timestamp(7450))
+    scenario.verify(~c1.data.splitStreams.contains(4))
+    scenario.verify(c3.data.ledger[c3.ledger_key.make(bob, 0)].balance == 150)
+
+    scenario.h3("rewardsCollected: amount 500, remainingRewards 1500")
+    c1.ep().run(sender = admin, amount = sp.mutez(2000))
+    c1.collect_management_rewards(address = admin, amount = 500).run(sender = admin)
+    scenario.verify(c1.data.rewards == 1500)
+
+
+@sp.add_test(name = "Radiate batch cancel")
+def test():
+    scenario, c1, c2, c3 = setup("Radiate batch cancellation")
+
+    ######################################### batch cancel begins here #####################################
+
+    scenario.h2("Cancelling several streams at once")
+    c1.createStreams([
+        sp.record(
+            ratePerSecond = sp.nat(1),
+            startTime = sp.timestamp(8000),
+            stopTime = sp.timestamp(8100),
+            receiver = user2.address,
+            token = FA12Token(c2)
+        ),
+        sp.record(
+            ratePerSecond = sp.nat(1),
+            startTime = sp.timestamp(8000),
+            stopTime = sp.timestamp(8100),
+            receiver = bob,
+            token = FA2Token(c3)
+        ),
+        sp.record(
+            ratePerSecond = sp.nat(1),
+            startTime = sp.timestamp(8000),
+            stopTime = sp.timestamp(8100),
+            receiver = user2.address,
+            token = FA2Token(c3)
+        )
+    ]).run(sender = user1, now = sp.timestamp(7900))
+
+    scenario.h3("Only a party of every stream can cancel them")
+    c1.cancelStreams([0, 2]).run(sender = bob, now = sp.timestamp(8050), valid = False)
+
+    scenario.h3("One FA1.2 transfer and one FA2 transfer pay everyone")
+    c1.cancelStreams([0, 1, 2]).run(sender = user1, now = sp.timestamp(8050))
+    scenario.verify(~c1.data.streams.contains(0))
+    scenario.verify(~c1.data.streams.contains(1))
+    scenario.verify(~c1.data.streams.contains(2))
+    scenario.verify(c2.data.balances[user2.address].balance == 50)
+    scenario.verify(c3.data.ledger[c3.ledger_key.make(user2.address, 0)].balance == 50)
+    scenario.verify(c3.data.ledger[c3.ledger_key.make(bob, 0)].balance == 50)
+
+
+@sp.add_test(name = "Radiate import")
+def test():
+    scenario, c1, c2, c3 = setup("Radiate migration of streams")
+
+    ######################################### import begins here #####################################
+
+    scenario.h2("Importing streams from a previous deployment")
+    imported = sp.record(
+        ratePerSecond = sp.nat(2),
+        startTime = sp.timestamp(9000),
+        stopTime = sp.timestamp(9100),
+        receiver = user2.address,
+        sender = alice,
+        token = tez,
+        remainingBalance = sp.nat(150),
+        segments = sp.list([], t = Segment)
+    )
+
+    scenario.h3("Only the admin can import, with the exact remaining balances")
+    c1.importStreams([imported]).run(sender = alice, amount = sp.mutez(150), now = sp.timestamp(9050), valid = False)
+    c1.importStreams([imported]).run(sender = admin, amount = sp.mutez(200), now = sp.timestamp(9050), valid = False)
+
+    scenario.h3("Failing case, more was withdrawn than streamed by now")
+    scenario.p("At 9050 only 100 of the 200 were streamed, so at least 100 must remain.")
+    c1.importStreams([sp.record(
+        ratePerSecond = sp.nat(2),
+        startTime = sp.timestamp(9000),
+        stopTime = sp.timestamp(9100),
+        receiver = user2.address,
+        sender = alice,
+        token = tez,
+        remainingBalance = sp.nat(99),
+        segments = sp.list([], t = Segment)
+    )]).run(sender = admin, amount = sp.mutez(99), now = sp.timestamp(9050), valid = False)
+
+    scenario.h3("A running stream keeps its schedule and what was already withdrawn")
+    scenario.p("Expected event, not asserted: streamCreated with streamId 0, alice to user2, tez, deposit 200, remainingBalance 150")
+    c1.importStreams([imported]).run(sender = admin, amount = sp.mutez(150), now = sp.timestamp(9050))
+    scenario.verify(c1.data.streams[0].withdrawn == 50)
+    scenario.verify(c1.data.streamsBySender[alice].contains(0))
+
+    c1.withdraw(streamId = 0, amount = 50).run(sender = user2, now = sp.timestamp(9050))
+    c1.withdraw(streamId = 0, amount = 1).run(sender = user2, now = sp.timestamp(9050), valid = False)
+
+    scenario.h3("Imports are closed for good once finished")
+    c1.finishImport().run(sender = admin)
+    c1.importStreams([imported]).run(sender = admin, amount = sp.mutez(150), now = sp.timestamp(9050), valid = False)
+
+
+@sp.add_test(name = "Radiate permits")
+def test():
+    scenario, c1, c2, c3 = setup("Radiate withdrawals with permits")
+
+    ######################################### permits begin here #####################################
+
+    scenario.h2("Withdrawals signed by the receiver and relayed by someone else")
+    chainId = sp.chain_id_cst("0x9caecab9")
+
+    c1.createStream(
+        ratePerSecond = sp.nat(1),
+        startTime = sp.timestamp(9200),
+        stopTime = sp.timestamp(9300),
+        receiver = user2.address,
+        token = tez
+    ).run(sender = alice, amount = sp.mutez(100), now = sp.timestamp(9100))
+
+    def permit(account, counter, streamId, amount):
+        return sp.record(
+            publicKey = account.public_key,
+            signature = sp.make_signature(
+                account.secret_key,
+                sp.pack(permitPayload(chainId, c1.address, sp.nat(counter), sp.nat(streamId), sp.nat(amount)))
+            ),
+            streamId = streamId,
+            amount = amount
+        )
+
+    scenario.h3("A permit signed by someone else than the receiver is rejected")
+    c1.withdrawWithPermit([permit(user1, 0, 0, 10)]).run(sender = bob, now = sp.timestamp(9250), chain_id = chainId, valid = False)
+
+    scenario.h3("The relayer submits the permits of the receiver in one operation")
+    c1.withdrawWithPermit([permit(user2, 0, 0, 10), permit(user2, 1, 0, 20)]).run(sender = bob, now = sp.timestamp(9250), chain_id = chainId)
+    scenario.verify(c1.data.streams[0].withdrawn == 30)
+    scenario.verify(c1.data.permitCounters[user2.address] == 2)
+
+    scenario.h3("A permit cannot be replayed")
+    c1.withdrawWithPermit([permit(user2, 1, 0, 20)]).run(sender = bob, now = sp.timestamp(9260), chain_id = chainId, valid = False)
+
+
+@sp.add_test(name = "Radiate FA2 only")
+def test():
+    scenario, c1, c2, c3 = setup(
+        "Radiate Contract without tez, FA1.2 and rewards",
+        Radiate_config(
+            support_tez = False,
+            support_FA12 = False,
+            use_sub_entry_points = False,
+            lazy_entry_points = True
+        )
+    )
+
+    scenario.h2("Tez and FA1.2 streams are rejected")
+    c1.createStream(
+        ratePerSecond = sp.nat(10),
+        startTime = sp.timestamp(100),
+        stopTime = sp.timestamp(200),
+        receiver = user2.address,
+        token = tez
+    ).run(sender = alice, amount = sp.mutez(1000), now = sp.timestamp(0), valid = False)
+    c1.createStream(
+        ratePerSecond = sp.nat(10),
+        startTime = sp.timestamp(100),
+        stopTime = sp.timestamp(200),
+        receiver = user2.address,
+        token = FA12Token(c2)
+    ).run(sender = user1, now = sp.timestamp(0), valid = False)
+
+    scenario.h2("FA2 streams work as in the full contract")
+    c1.createStream(
+        ratePerSecond = sp.nat(10),
+        startTime = sp.timestamp(100),
+        stopTime = sp.timestamp(200),
+        receiver = user2.address,
+        token = FA2Token(c3)
+    ).run(sender = user1, now = sp.timestamp(0))
+
+    c1.withdraw(streamId = 0, amount = 300).run(sender = user2, now = sp.timestamp(150))
+    # cancelStream is a lazy entry point in this deployment
+    c1.cancelStream(streamId = 0).run(sender = user1, now = sp.timestamp(160))
+    scenario.verify(~c1.data.streams.contains(0))
+    scenario.verify(c3.data.ledger[c3.ledger_key.make(user2.address, 0)].balance == 600)
+
+    scenario.h2("Off-chain views")
+    c1.createStream(
+        ratePerSecond = sp.nat(10),
+        startTime = sp.timestamp(300),
+        stopTime = sp.timestamp(400),
+        receiver = user2.address,
+        token = FA2Token(c3)
+    ).run(sender = user1, now = sp.timestamp(200))
+
+    c1.createSplitStream(
+        ratePerSecond = sp.nat(2),
+        startTime = sp.timestamp(300),
+        stopTime = sp.timestamp(400),
+        receivers = {user2.address: 1, bob: 1},
+        token = FA2Token(c3)
+    ).run(sender = user1, now = sp.timestamp(200))
+
+    stream = sp.record(
+        ratePerSecond = 10,
+        startTime = sp.timestamp(300),
+        stopTime = sp.timestamp(400),
+        receiver = user2.address,
+        sender = user1.address,
+        tokenIndex = 0,
+        withdrawn = 0
+    )
+
+    splitStream = sp.record(
+        ratePerSecond = 2,
+        startTime = sp.timestamp(300),
+        stopTime = sp.timestamp(400),
+        sender = user1.address,
+        tokenIndex = 0,
+        receivers = {user2.address: sp.record(share = 1, withdrawn = 0), bob: sp.record(share = 1, withdrawn = 0)},
+        totalShares = 2,
+        withdrawn = 0
+    )
+
+    scenario.h3("getStreams skips the cancelled stream 0 and lists the split stream 2 apart")
+    getStreams = TestOffchainView(c1, c1.getStreams)
+    scenario.register(getStreams)
+    getStreams.compute(data = c1.data, params = sp.record(fromId = 0, count = 5)).run(now = sp.timestamp(350))
+    scenario.verify_equal(
+        getStreams.data.result,
+        sp.some(sp.record(
+            streams = sp.list([sp.record(streamId = 1, stream = stream, segments = [], receiverBalance = 500, senderBalance = 500)]),
+            splitStreams = sp.list([sp.record(streamId = 2, stream = splitStream, receiverBalances = {user2.address: 50, bob: 50}, senderBalance = 100)])
+        ))
+    )
+
+    scenario.h3("getStreamsFor computes the balances at the given time")
+    getStreamsFor = TestOffchainView(c1, c1.getStreamsFor)
+    scenario.register(getStreamsFor)
+    getStreamsFor.compute(data = c1.data, params = sp.record(address = user2.address, now = sp.timestamp(400)))
+    scenario.verify_equal(
+        getStreamsFor.data.result,
+        sp.some(sp.record(
+            streams = sp.list([sp.record(streamId = 1, stream = stream, segments = [], receiverBalance = 1000, senderBalance = 0)]),
+            splitStreams = sp.list([sp.record(streamId = 2, stream = splitStream, receiverBalances = {user2.address: 100, bob: 100}, senderBalance = 0)])
+        ))
+    )
+
+
+@sp.add_test(name = "Radiate inline")
+def test():
+    scenario, c1, c2, c3 = setup(
+        "Radiate Contract without sub entry points",
+        Radiate_config(use_sub_entry_points = False)
+    )
+
+    scenario.h2("Batches, segmented and split streams with the computations inlined")
+    c1.createStreams([
+        sp.record(
+            ratePerSecond = sp.nat(1),
+            startTime = sp.timestamp(200),
+            stopTime = sp.timestamp(300),
+            receiver = user2.address,
+            token = tez
+        ),
+        sp.record(
+            ratePerSecond = sp.nat(2),
+            startTime = sp.timestamp(200),
+            stopTime = sp.timestamp(300),
+            receiver = bob,
+            token = FA2Token(c3)
+        )
+    ]).run(sender = user1, amount = sp.mutez(100), now = sp.timestamp(100))
+
+    c1.createSegmentedStream(
+        startTime = sp.timestamp(200),
+        segments = [
+            sp.record(segmentEnd = sp.timestamp(250), ratePerSecond = sp.nat(0)),
+            sp.record(segmentEnd = sp.timestamp(300), ratePerSecond = sp.nat(2))
+        ],
+        receiver = user2.address,
+        token = FA2Token(c3)
+    ).run(sender = user1, now = sp.timestamp(100))
+
+    scenario.h3("withdrawMany")
+    c1.withdrawMany([
+        sp.record(streamId = 0, amount = 50),
+        sp.record(streamId = 2, amount = 20)
+    ]).run(sender = user2, now = sp.timestamp(260))
+    scenario.verify(c1.data.streams[0].withdrawn == 50)
+    scenario.verify(c1.data.streams[2].withdrawn == 20)
+
+    scenario.h3("cancelStreams")
+    c1.cancelStreams([1, 2]).run(sender = user1, now = sp.timestamp(275))
+    scenario.verify(~c1.data.streams.contains(1))
+    scenario.verify(~c1.data.streams.contains(2))
+    scenario.verify(c3.data.ledger[c3.ledger_key.make(bob, 0)].balance == 150)
+    scenario.verify(c3.data.ledger[c3.ledger_key.make(user2.address, 0)].balance == 50)
+
+    scenario.h3("settle")
+    c1.settle([0]).run(sender = admin, now = sp.timestamp(300))
+    scenario.verify(~c1.data.streams.contains(0))
+
+    scenario.h3("Split streams")
+    c1.createSplitStream(
+        ratePerSecond = sp.nat(2),
+        startTime = sp.timestamp(400),
+        stopTime = sp.timestamp(500),
+        receivers = {user2.address: 1, bob: 1},
+        token = FA2Token(c3)
+    ).run(sender = user1, now = sp.timestamp(300))
 
+    c1.withdrawSplit(streamId = 3, amount = 50).run(sender = bob, now = sp.timestamp(450))
+    c1.cancelSplitStream(streamId = 3).run(sender = user1, now = sp.timestamp(450))
+    scenario.verify(~c1.data.splitStreams.contains(3))
+    scenario.verify(c3.data.ledger[c3.ledger_key.make(bob, 0)].balance == 200)
+    scenario.verify(c3.data.ledger[c3.ledger_key.make(user2.address, 0)].balance == 100)